@@ -3,10 +3,39 @@
 """Library containing some commonly used mathematical functions and their derivatives"""
 
 
+import warnings
 import numpy as np
 import scipy.special
 
 
+# ------ Batches of parameters ------ #
+
+
+# All models, their Jacobians and residuals accept either a single parameter vector
+# params, or a 2D-ndarray of shape (K, len(params)) of K parameter vectors, which are
+# broadcast against x (an M-length array, or a (K, M) array of per-vector x).
+# With K parameter vectors, models return (K, M) arrays and their Jacobians return
+# (K, M, len(params)) arrays. Parameters indexed as params[i] of shape (K, 1), as passed
+# by batchcurvefit, are also accepted
+
+
+# Split params into its individual parameters, as (K, 1) columns if params is a
+# (K, len(params)) array of K parameter vectors
+def _splitParams(params):
+    params = np.asarray(params, dtype=float)
+    if params.ndim == 2:
+        return params.T[:, :, np.newaxis]
+    else:
+        return params
+
+
+# Stack the partial derivatives of a model with respect to each of its parameters into
+# its Jacobian of shape (..., len(x), len(params)), broadcasting the partial derivatives
+# that do not depend on the parameters against the parameter vectors in params
+def _stackPartials(params, *partials):
+    return np.stack(np.broadcast_arrays(params[0], *partials)[1:], axis=-1)
+
+
 # ------ Linear equation ------ #
 
 
@@ -14,6 +43,7 @@ import scipy.special
 # where params[0] = A
 #       params[1] = B
 def linear(params, x):
+    params = _splitParams(params)
     return params[0]*x + params[1]
 
 
@@ -21,9 +51,27 @@ def linear(params, x):
 # where params[0] = A
 #       params[1] = B
 def linearResidual(params, x, y):
+    params = _splitParams(params)
     return params[0]*x + params[1] - y
 
 
+# Compute the Jacobian of linear
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def linearPrime(params, x):
+    params = _splitParams(params)
+    partial_p0s = x
+    partial_p1s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s)
+
+
+# Compute the initial guesses of linear by linear regression
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def linearInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    slope, intercept = _linearRegression(x, y, mask)
+    return np.column_stack((slope, intercept))
+
+
 # ------ Single exponential with tau ------ #
 
 
@@ -32,16 +80,18 @@ def linearResidual(params, x, y):
 #       params[1] = tau
 #       params[2] = C
 def singleExp(params, x):
+    params = _splitParams(params)
     return params[0]*np.exp(-x/params[1]) + params[2]
 
 
 # Compute the Jacobian of singleExp
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def singleExpPrime(params, x):
+    params = _splitParams(params)
     partial_p0s = np.exp(-x/params[1])
     partial_p1s = params[0]*x*np.exp(-x/params[1])/(params[1]**2)
-    partial_p2s = np.ones(len(x))
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s))
+    partial_p2s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s)
 
 
 # Compute the residual of A*exp(-t/tau) + C - y
@@ -49,9 +99,21 @@ def singleExpPrime(params, x):
 #       params[1] = tau
 #       params[2] = C
 def singleExpResidual(params, x, y):
+    params = _splitParams(params)
     return params[0]*np.exp(-x/params[1]) + params[2] - y
 
 
+# Compute the initial guesses of singleExp from the log-linear decay rate, and A and C
+# by linear least squares given tau
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def singleExpInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    k = _decayRate(x, y, mask)
+    basis = np.stack((np.exp(-k[:, np.newaxis]*x), np.ones_like(x)), axis=-1)
+    amplitudes = _linearAmplitudes(basis, y, mask)
+    return np.column_stack((amplitudes[:, 0], 1/k, amplitudes[:, 1]))
+
+
 # ------ Single exponential with k ------ #
 
 
@@ -60,16 +122,18 @@ def singleExpResidual(params, x, y):
 #       params[1] = k
 #       params[2] = C
 def singleExpK(params, x):
+    params = _splitParams(params)
     return params[0]*np.exp(-params[1]*x) + params[2]
 
 
 # Compute the Jacobian of singleExpK
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def singleExpKPrime(params, x):
+    params = _splitParams(params)
     partial_p0s = np.exp(-params[1]*x)
     partial_p1s = -params[0]*x*np.exp(-params[1]*x)
-    partial_p2s = np.ones(len(x))
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s))
+    partial_p2s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s)
 
 
 # Compute the residual of A*exp(-kt) + C - y
@@ -77,9 +141,18 @@ def singleExpKPrime(params, x):
 #       params[1] = k
 #       params[2] = C
 def singleExpKResidual(params, x, y):
+    params = _splitParams(params)
     return params[0]*np.exp(-params[1]*x) + params[2] - y
 
 
+# Compute the initial guesses of singleExpK as for singleExp
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def singleExpKInit(x, y):
+    params0 = singleExpInit(x, y)
+    params0[:, 1] = 1/params0[:, 1]
+    return params0
+
+
 # ------ Double exponential with taus ------ #
 
 
@@ -90,18 +163,20 @@ def singleExpKResidual(params, x, y):
 #       params[3] = tau2
 #       params[4] = C
 def doubleExp(params, x):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/params[3])) + params[2]*np.exp(-x/params[3]) + params[4]
 
 
 # Compute the Jacobian of doubleExp
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def doubleExpPrime(params, x):
+    params = _splitParams(params)
     partial_p0s = np.exp(-x*(1/params[1]+1/params[3]))
     partial_p1s = params[0]*x*np.exp(-x*(1/params[1]+1/params[3]))/(params[1]**2)
     partial_p2s = np.exp(-x/params[3])
-    partial_p3s = params[2]*x*np.exp(-x/params[3])/(params[3]**2)
-    partial_p4s = np.ones(len(x))
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s, partial_p3s, partial_p4s))
+    partial_p3s = (params[0]*x*np.exp(-x*(1/params[1]+1/params[3])) + params[2]*x*np.exp(-x/params[3]))/(params[3]**2)
+    partial_p4s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s, partial_p3s, partial_p4s)
 
 
 # Compute the residual of (A1*exp(-t/tau1) + A2)*exp(-t/tau2) + C - y
@@ -111,9 +186,22 @@ def doubleExpPrime(params, x):
 #       params[3] = tau2
 #       params[4] = C
 def doubleExpResidual(params, x, y):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/params[3])) + params[2]*np.exp(-x/params[3]) + params[4] - y
 
 
+# Compute the initial guesses of doubleExp from the log-linear decay rate k, taking
+# 1/tau2 = k/3 and 1/tau1+1/tau2 = 3k, and A1, A2 and C by linear least squares given the taus
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def doubleExpInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    k = _decayRate(x, y, mask)[:, np.newaxis]
+    basis = np.stack((np.exp(-3*k*x), np.exp(-k*x/3), np.ones_like(x)), axis=-1)
+    amplitudes = _linearAmplitudes(basis, y, mask)
+    k = k[:, 0]
+    return np.column_stack((amplitudes[:, 0], 3/(8*k), amplitudes[:, 1], 3/k, amplitudes[:, 2]))
+
+
 # ------ Double exponential with k's ------ #
 
 
@@ -124,18 +212,20 @@ def doubleExpResidual(params, x, y):
 #       params[3] = k2
 #       params[4] = C
 def doubleExpK(params, x):
+    params = _splitParams(params)
     return params[0]*np.exp(-(params[1]+params[3])*x) + params[2]*np.exp(-params[3]*x) + params[4]
 
 
 # Compute the Jacobian of doubleExp
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def doubleExpKPrime(params, x):
+    params = _splitParams(params)
     partial_p0s = np.exp(-(params[1]+params[3])*x)
     partial_p1s = -params[0]*x*np.exp(-(params[1]+params[3])*x)
     partial_p2s = np.exp(-params[3]*x)
-    partial_p3s = -params[2]*x*np.exp(-params[3]*x)
-    partial_p4s = np.ones(len(x))
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s, partial_p3s, partial_p4s))
+    partial_p3s = -params[0]*x*np.exp(-(params[1]+params[3])*x) - params[2]*x*np.exp(-params[3]*x)
+    partial_p4s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s, partial_p3s, partial_p4s)
 
 
 # Compute the residual of (A1*exp(-k1t) + A2)*exp(-k2t) + C - y
@@ -145,9 +235,18 @@ def doubleExpKPrime(params, x):
 #       params[3] = k2
 #       params[4] = C
 def doubleExpKResidual(params, x, y):
+    params = _splitParams(params)
     return params[0]*np.exp(-(params[1]+params[3])*x) + params[2]*np.exp(-params[3]*x) + params[4] - y
 
 
+# Compute the initial guesses of doubleExpK as for doubleExp
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def doubleExpKInit(x, y):
+    params0 = doubleExpInit(x, y)
+    params0[:, [1, 3]] = 1/params0[:, [1, 3]]
+    return params0
+
+
 # ------ Double exponential with taus, constant tau2 ------ #
 
 
@@ -158,17 +257,19 @@ def doubleExpKResidual(params, x, y):
 #       params[3] = C
 #       constants[0] = tau2
 def doubleExpConstT2(params, x, constants):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/constants[0])) + params[2]*np.exp(-x/constants[0]) + params[3]
 
 
 # Compute the Jacobian of doubleExpConstT2
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def doubleExpConstT2Prime(params, x, constants):
+    params = _splitParams(params)
     partial_p0s = np.exp(-x*(1/params[1]+1/constants[0]))
     partial_p1s = params[0]*x*np.exp(-x*(1/params[1]+1/constants[0]))/(params[1]**2)
     partial_p2s = np.exp(-x/constants[0])
-    partial_p3s = np.ones(len(x))
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s, partial_p3s))
+    partial_p3s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s, partial_p3s)
 
 
 # Compute the residual of (A1*exp(-t/tau1) + A2)*exp(-t/tau2) + C - y
@@ -178,9 +279,21 @@ def doubleExpConstT2Prime(params, x, constants):
 #       params[3] = C
 #       constants[0] = tau2
 def doubleExpConstT2Residual(params, x, y, constants):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/constants[0])) + params[2]*np.exp(-x/constants[0]) + params[3] - y
 
 
+# Compute the initial guesses of doubleExpConstT2 from the log-linear decay rate k, taking
+# 1/tau1 = 3k, and A1, A2 and C by linear least squares given tau1
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def doubleExpConstT2Init(x, y, constants):
+    x, y, mask = _initArrays(x, y)
+    k1 = 3*_decayRate(x, y, mask)[:, np.newaxis]
+    basis = np.stack((np.exp(-x*(k1+1/constants[0])), np.exp(-x/constants[0]), np.ones_like(x)), axis=-1)
+    amplitudes = _linearAmplitudes(basis, y, mask)
+    return np.column_stack((amplitudes[:, 0], 1/k1[:, 0], amplitudes[:, 1], amplitudes[:, 2]))
+
+
 # ------ Double exponential with taus, constant tau2 and C ------ #
 
 
@@ -191,16 +304,18 @@ def doubleExpConstT2Residual(params, x, y, constants):
 #       constants[0] = tau2
 #       constants[1] = C
 def doubleExpConstT2C(params, x, constants):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/constants[0])) + params[2]*np.exp(-x/constants[0]) + constants[1]
 
 
 # Compute the Jacobian of doubleExpConstT2C
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def doubleExpConstT2CPrime(params, x, constants):
+    params = _splitParams(params)
     partial_p0s = np.exp(-x*(1/params[1]+1/constants[0]))
     partial_p1s = params[0]*x*np.exp(-x*(1/params[1]+1/constants[0]))/(params[1]**2)
     partial_p2s = np.exp(-x/constants[0])
-    return np.column_stack((partial_p0s, partial_p1s, partial_p2s))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s)
 
 
 # Compute the residual of (A1*exp(-t/tau1) + A2)*exp(-t/tau2) + C - y
@@ -210,17 +325,48 @@ def doubleExpConstT2CPrime(params, x, constants):
 #       constants[0] = tau2
 #       constants[1] = C
 def doubleExpConstT2CResidual(params, x, y, constants):
+    params = _splitParams(params)
     return params[0]*np.exp(-x*(1/params[1]+1/constants[0])) + params[2]*np.exp(-x/constants[0]) + constants[1] - y
 
 
+# Compute the initial guesses of doubleExpConstT2C as for doubleExpConstT2, with C given
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def doubleExpConstT2CInit(x, y, constants):
+    x, y, mask = _initArrays(x, y)
+    k1 = 3*_decayRate(x, y, mask)[:, np.newaxis]
+    basis = np.stack((np.exp(-x*(k1+1/constants[0])), np.exp(-x/constants[0])), axis=-1)
+    amplitudes = _linearAmplitudes(basis, y - constants[1], mask)
+    return np.column_stack((amplitudes[:, 0], 1/k1[:, 0], amplitudes[:, 1]))
+
+
 # ------ Distributions ------ #
 
 
 # Compute the pmf of Poisson distribution, pre-normalized
 def poisson(params, x):
+    params = _splitParams(params)
     return params[0]*(params[1]**x)*np.exp(-params[1])/scipy.special.gamma(x+1)
 
 
+# Compute the Jacobian of poisson
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def poissonPrime(params, x):
+    params = _splitParams(params)
+    partial_p0s = (params[1]**x)*np.exp(-params[1])/scipy.special.gamma(x+1)
+    partial_p1s = params[0]*(x/params[1] - 1)*partial_p0s
+    return _stackPartials(params, partial_p0s, partial_p1s)
+
+
+# Compute the initial guesses of poisson from the moments of the distribution,
+# i.e. the normalization sum(y) and the mean sum(x*y)/sum(y)
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def poissonInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    y = np.where(mask, np.maximum(y, 0), 0.)
+    with np.errstate(all='ignore'):
+        return np.column_stack((np.sum(y, axis=1), np.sum(np.where(mask, x, 0.)*y, axis=1)/np.sum(y, axis=1)))
+
+
 # ------ Folding ------ #
 
 
@@ -230,56 +376,145 @@ def poisson(params, x):
 #       params[1] = dS
 #       params[2] = C
 def fractionFoldedVsTemp(params, x):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
-    dH = float(params[0])
-    dS = float(params[1])/1000
-    C = float(params[2])
+    dH = params[0]
+    dS = params[1]/1000
+    C = params[2]
     return 1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C
 
 
+# Compute the partial derivatives of the fraction folded 1 / (exp(dH/RT)*exp(-dS/R) + 1)
+# with respect to params[0] = dH and params[1] = dS (in cal/mol/K), and the fraction folded
+# Shared by the Jacobians of the folding models
+def _fractionFoldedPartials(params, x):
+    R = 1.98722/1000
+    T = 273.15 + x
+    dH = params[0]
+    dS = params[1]/1000
+    E = np.exp(dH/R/T)*np.exp(-dS/R)
+    ff = 1/(E+1)
+    partial_dH = -E/((E+1)**2)/R/T
+    partial_dS = E/((E+1)**2)/R/1000
+    return partial_dH, partial_dS, ff
+
+
+# Compute the Jacobian of fractionFoldedVsTemp
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def fractionFoldedVsTempPrime(params, x):
+    params = _splitParams(params)
+    partial_p0s, partial_p1s, _ = _fractionFoldedPartials(params, x)
+    partial_p2s = np.ones(np.shape(x))
+    return _stackPartials(params, partial_p0s, partial_p1s, partial_p2s)
+
+
+# Compute the initial guesses of fractionFoldedVsTemp from the logit of the fraction
+# folded vs 1/T, taking C such that the data are centered in [C, 1+C]
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def fractionFoldedVsTempInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    C = _midRange(y, mask) - 0.5
+    dH, dS = _foldingParams(x, y - C[:, np.newaxis], mask)
+    return np.column_stack((dH, dS, C))
+
+
 # Compute the fraction folded as a function of temperature
 # i.e. 1 / (exp(dH/RT)*exp(-dS/R) + 1) + C
 # where params[0] = dH
 #       params[1] = dS
 #       constants[0] = C
 def fractionFoldedVsTempC(params, x, constants):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
     dH = params[0]
-    dS = float(params[1])/1000
+    dS = params[1]/1000
     C = float(constants[0])
     return 1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C
 
 
+# Compute the Jacobian of fractionFoldedVsTempC
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def fractionFoldedVsTempCPrime(params, x, constants):
+    params = _splitParams(params)
+    partial_p0s, partial_p1s, _ = _fractionFoldedPartials(params, x)
+    return _stackPartials(params, partial_p0s, partial_p1s)
+
+
+# Compute the initial guesses of fractionFoldedVsTempC from the logit of the fraction
+# folded vs 1/T
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def fractionFoldedVsTempCInit(x, y, constants):
+    x, y, mask = _initArrays(x, y)
+    return np.column_stack(_foldingParams(x, y - constants[0], mask))
+
+
 # Compute the fraction unfolded as a function of temperature
 # i.e. 1 - 1 / (exp(dH/RT)*exp(-dS/R) + 1) + C
 # where params[0] = dH
 #       params[1] = dS
 #       params[2] = C
 def fractionUnfoldedVsTemp(params, x):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
     dH = params[0]
-    dS = float(params[1])/1000
-    C = float(params[2])
+    dS = params[1]/1000
+    C = params[2]
     return 1-1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C
 
 
+# Compute the Jacobian of fractionUnfoldedVsTemp
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def fractionUnfoldedVsTempPrime(params, x):
+    params = _splitParams(params)
+    partial_dH, partial_dS, _ = _fractionFoldedPartials(params, x)
+    partial_p2s = np.ones(np.shape(x))
+    return _stackPartials(params, -partial_dH, -partial_dS, partial_p2s)
+
+
+# Compute the initial guesses of fractionUnfoldedVsTemp from the logit of the fraction
+# folded vs 1/T, taking C such that the data are centered in [C, 1+C]
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def fractionUnfoldedVsTempInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    C = _midRange(y, mask) - 0.5
+    dH, dS = _foldingParams(x, 1 - (y - C[:, np.newaxis]), mask)
+    return np.column_stack((dH, dS, C))
+
+
 # Compute the fraction unfolded as a function of temperature
 # i.e. 1 - 1 / (exp(dH/RT)*exp(-dS/R) + 1) + C
 # where params[0] = dH
 #       params[1] = dS
 #       constants[0] = C
 def fractionUnfoldedVsTempC(params, x, constants):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
     dH = params[0]
-    dS = float(params[1])/1000
+    dS = params[1]/1000
     C = float(constants[0])
     return 1-1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C
 
 
+# Compute the Jacobian of fractionUnfoldedVsTempC
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def fractionUnfoldedVsTempCPrime(params, x, constants):
+    params = _splitParams(params)
+    partial_dH, partial_dS, _ = _fractionFoldedPartials(params, x)
+    return _stackPartials(params, -partial_dH, -partial_dS)
+
+
+# Compute the initial guesses of fractionUnfoldedVsTempC from the logit of the fraction
+# folded vs 1/T
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def fractionUnfoldedVsTempCInit(x, y, constants):
+    x, y, mask = _initArrays(x, y)
+    return np.column_stack(_foldingParams(x, 1 - (y - constants[0]), mask))
+
+
 # Compute the fluorescence of the donor due to unfolding as a function of temperature
 # assuming that there is a residual fluorescence C when totally unfolded
 # i.e. [1 - 1 / (exp(dH/RT)*exp(-dS/R) + 1)] + C * 1 / (exp(dH/RT)*exp(-dS/R) + 1)
@@ -287,14 +522,34 @@ def fractionUnfoldedVsTempC(params, x, constants):
 #       params[1] = dS
 #       params[2] = C
 def FRETvsTemp(params, x):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
     dH = params[0]
-    dS = float(params[1])/1000
-    C = float(params[2])
+    dS = params[1]/1000
+    C = params[2]
     return 1-1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C/(np.exp(dH/R/T)*np.exp(-dS/R)+1)
 
 
+# Compute the Jacobian of FRETvsTemp
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def FRETvsTempPrime(params, x):
+    params = _splitParams(params)
+    partial_dH, partial_dS, ff = _fractionFoldedPartials(params, x)
+    C = params[2]
+    return _stackPartials(params, (C-1)*partial_dH, (C-1)*partial_dS, ff)
+
+
+# Compute the initial guesses of FRETvsTemp from the logit of the fraction folded vs 1/T,
+# taking the smallest signal as the residual fluorescence C of the folded state
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def FRETvsTempInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    C = np.minimum(np.min(np.where(mask, y, np.inf), axis=1), 0.99)
+    dH, dS = _foldingParams(x, (1 - y)/(1 - C[:, np.newaxis]), mask)
+    return np.column_stack((dH, dS, C))
+
+
 # Compute the fluorescence of the donor due to unfolding as a function of temperature
 # assuming that there is a residual fluorescence C when totally unfolded
 # i.e. [1 - 1 / (exp(dH/RT)*exp(-dS/R) + 1)] + C * 1 / (exp(dH/RT)*exp(-dS/R) + 1)
@@ -302,14 +557,31 @@ def FRETvsTemp(params, x):
 #       params[1] = dS
 #       constants[2] = C
 def FRETvsTempC(params, x, constants):
+    params = _splitParams(params)
     R = 1.98722/1000
     T = 273.15 + x
     dH = params[0]
-    dS = float(params[1])/1000
+    dS = params[1]/1000
     C = float(constants[0])
     return 1-1/(np.exp(dH/R/T)*np.exp(-dS/R)+1) + C/(np.exp(dH/R/T)*np.exp(-dS/R)+1)
 
 
+# Compute the Jacobian of FRETvsTempC
+# Returns a 2D-ndarray of shape (len(x), len(params))
+def FRETvsTempCPrime(params, x, constants):
+    params = _splitParams(params)
+    partial_dH, partial_dS, _ = _fractionFoldedPartials(params, x)
+    C = float(constants[0])
+    return _stackPartials(params, (C-1)*partial_dH, (C-1)*partial_dS)
+
+
+# Compute the initial guesses of FRETvsTempC from the logit of the fraction folded vs 1/T
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def FRETvsTempCInit(x, y, constants):
+    x, y, mask = _initArrays(x, y)
+    return np.column_stack(_foldingParams(x, (1 - y)/(1 - constants[0]), mask))
+
+
 # ------ Binding ------ #
 
 
@@ -318,12 +590,158 @@ def FRETvsTempC(params, x, constants):
 # where params[0] = Kd
 #       params[1] = fmax
 def eqBinding(params, x):
+    params = _splitParams(params)
     return params[1] / (1 + params[0]/x)
 
 
 # Compute the Jacobian of eqBinding
 # Returns a 2D-ndarray of shape (len(x), len(params))
 def eqBindingPrime(params, x):
+    params = _splitParams(params)
     partial_p0s = -(params[1]/x)/((1+params[0]/x)**2)
     partial_p1s = 1/(1+params[0]/x)
-    return np.column_stack((partial_p0s, partial_p1s))
+    return _stackPartials(params, partial_p0s, partial_p1s)
+
+
+# Compute the initial guesses of eqBinding, taking the largest signal as fmax and the
+# median of the Kd = x*(fmax/y-1) of the datapoints within the binding transition
+# Returns a 2D-ndarray of shape (len(y), len(params))
+def eqBindingInit(x, y):
+    x, y, mask = _initArrays(x, y)
+    fmax = np.max(np.where(mask, y, -np.inf), axis=1)
+    with np.errstate(all='ignore'):
+        fraction = y / fmax[:, np.newaxis]
+        valid = mask & (fraction > 0.05) & (fraction < 0.95)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            Kd = np.nanmedian(np.where(valid, x*(1/fraction - 1), np.nan), axis=1)
+    return np.column_stack((Kd, fmax))
+
+
+# ------ Initial guesses ------ #
+
+
+# Each model can register an initializer computing data-driven initial guesses of its
+# parameters for many curves at once, as model + 'Init'(x, y) or (x, y, constants), where
+# y is an (N, M) array with one curve per row (nan for missing data) and x is either an
+# M-length sequence or an (N, M) array. Initializers return an (N, len(params)) array, with
+# nan for the parameters that cannot be estimated from a curve
+
+
+# Convert x and y to (N, M) arrays with one curve per row and find their valid datapoints
+def _initArrays(x, y):
+    y = np.array(y, dtype=float, ndmin=2)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    mask = np.isfinite(x) & np.isfinite(y)
+    return x, y, mask
+
+
+# Return y at the smallest and at the largest valid x of each curve
+def _endValues(x, y, mask):
+    rows = np.arange(len(y))
+    first = y[rows, np.argmin(np.where(mask, x, np.inf), axis=1)]
+    last = y[rows, np.argmax(np.where(mask, x, -np.inf), axis=1)]
+    return first, last
+
+
+# Fit v = slope*u + intercept to the valid datapoints of each curve by linear regression
+# Returns N-length arrays of slopes and intercepts (nan if undetermined)
+def _linearRegression(u, v, mask):
+    with np.errstate(all='ignore'):
+        n = np.sum(mask, axis=1)
+        uMean = np.sum(np.where(mask, u, 0.), axis=1) / n
+        vMean = np.sum(np.where(mask, v, 0.), axis=1) / n
+        du = np.where(mask, u - uMean[:, np.newaxis], 0.)
+        dv = np.where(mask, v - vMean[:, np.newaxis], 0.)
+        slope = np.sum(du*dv, axis=1) / np.sum(du**2, axis=1)
+        return slope, vMean - slope*uMean
+
+
+# Solve y = sum_k a_k*basis_k for the amplitudes a_k of each curve by linear least squares,
+# given the basis functions as an (N, M, K) array. Returns an (N, K) array
+def _linearAmplitudes(basis, y, mask):
+    basis = np.where(mask[:, :, np.newaxis], basis, 0.)
+    A = np.einsum('nmi,nmj->nij', basis, basis)
+    b = np.einsum('nmi,nm->ni', basis, np.where(mask, y, 0.))
+    try:
+        return np.linalg.solve(A, b[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('nij,nj->ni', np.linalg.pinv(A), b)
+
+
+# Estimate the decay rate k of y = A*exp(-k*x) + C for each curve from the slope of
+# log((y-C)/A) vs x, taking y at the smallest and largest x as A+C and C, over the
+# datapoints well above the baseline. Falls back to 3/(range of x) if undetermined
+def _decayRate(x, y, mask):
+    first, last = _endValues(x, y, mask)
+    with np.errstate(all='ignore'):
+        u = (y - last[:, np.newaxis]) / (first - last)[:, np.newaxis]
+        valid = mask & (u > 0.1) & (u < 2)
+        slope, _ = _linearRegression(x, np.log(np.where(valid, u, 1.)), valid)
+        xRange = np.max(np.where(mask, x, -np.inf), axis=1) - np.min(np.where(mask, x, np.inf), axis=1)
+        return np.where(np.isfinite(slope) & (slope < 0), -slope, 3/xRange)
+
+
+# Return the middle of the range of y of each curve
+def _midRange(y, mask):
+    return (np.max(np.where(mask, y, -np.inf), axis=1) + np.min(np.where(mask, y, np.inf), axis=1)) / 2
+
+
+# Estimate dH and dS (in cal/mol/K) of the fraction folded 1/(exp(dH/RT)*exp(-dS/R)+1)
+# of each curve by linear regression of its logit log(1/ff-1) = dH/RT - dS/R vs 1/T
+def _foldingParams(x, ff, mask):
+    R = 1.98722/1000
+    T = 273.15 + x
+    ff = np.clip(ff, 0.01, 0.99)
+    slope, intercept = _linearRegression(1/T, np.log(1/ff - 1), mask & np.isfinite(ff))
+    return slope*R, -intercept*R*1000
+
+
+# ------ Registry ------ #
+
+
+# Registry of the models in this library, mapping the name of each model to the model
+# function, its Jacobian, its residual function and its initializer (None if not available)
+models = {}
+
+
+# Add a model to the registry
+def registerModel(func, jac=None, residual=None, init=None):
+    models[func.__name__] = {'func': func, 'jac': jac, 'residual': residual, 'init': init}
+
+
+# Return the registered Jacobian of a model function, or None if the model
+# is not registered or has no Jacobian
+def getJacobian(func):
+    entry = models.get(getattr(func, '__name__', None))
+    if entry is not None and entry['func'] is func:
+        return entry['jac']
+    else:
+        return None
+
+
+# Return the registered initializer of a model function, or None if the model
+# is not registered or has no initializer
+def getInit(func):
+    entry = models.get(getattr(func, '__name__', None))
+    if entry is not None and entry['func'] is func:
+        return entry['init']
+    else:
+        return None
+
+
+registerModel(linear, linearPrime, linearResidual, linearInit)
+registerModel(singleExp, singleExpPrime, singleExpResidual, singleExpInit)
+registerModel(singleExpK, singleExpKPrime, singleExpKResidual, singleExpKInit)
+registerModel(doubleExp, doubleExpPrime, doubleExpResidual, doubleExpInit)
+registerModel(doubleExpK, doubleExpKPrime, doubleExpKResidual, doubleExpKInit)
+registerModel(doubleExpConstT2, doubleExpConstT2Prime, doubleExpConstT2Residual, doubleExpConstT2Init)
+registerModel(doubleExpConstT2C, doubleExpConstT2CPrime, doubleExpConstT2CResidual, doubleExpConstT2CInit)
+registerModel(poisson, poissonPrime, init=poissonInit)
+registerModel(fractionFoldedVsTemp, fractionFoldedVsTempPrime, init=fractionFoldedVsTempInit)
+registerModel(fractionFoldedVsTempC, fractionFoldedVsTempCPrime, init=fractionFoldedVsTempCInit)
+registerModel(fractionUnfoldedVsTemp, fractionUnfoldedVsTempPrime, init=fractionUnfoldedVsTempInit)
+registerModel(fractionUnfoldedVsTempC, fractionUnfoldedVsTempCPrime, init=fractionUnfoldedVsTempCInit)
+registerModel(FRETvsTemp, FRETvsTempPrime, init=FRETvsTempInit)
+registerModel(FRETvsTempC, FRETvsTempCPrime, init=FRETvsTempCInit)
+registerModel(eqBinding, eqBindingPrime, init=eqBindingInit)
@@ -5,31 +5,110 @@
 
 
 import os, sys
+import time
+import hashlib
+import uuid
+import warnings
 import numpy as np
+import pandas as pd
 from scipy import optimize
 from scipy import stats
+from scipy import sparse
 import matplotlib.pyplot as plt
 from types import ModuleType
 from random import shuffle
+import fitfuns
 
-# To-add:
-# - Log likelihood
-# - Akaike criterion
-# - C.I.
-# - bootstrapping
 
+# Non-data descriptor that computes an attribute with method on first access
+# and caches it in the instance, so that it is only computed if ever needed
+class _lazyattr(object):
 
-class lsqcurvefit:
+    def __init__(self, name, method):
+        self.name = name
+        self.method = method
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = self.method(obj)
+        obj.__dict__[self.name] = value
+        return value
+
+
+# Compute the Jacobian of a model numerically by finite differences, perturbing each
+# parameter once for all datapoints (and all curves) at the same time
+# evalFunc(params) must return the model values as an (..., M) array for params of
+# shape (..., P). Returns an ndarray of shape (..., M, P)
+def _finiteDiffJacobian(evalFunc, params, epsilon=None, scheme='forward'):
+    params = np.asarray(params, dtype=float)
+    if epsilon:
+        h = np.ones_like(params) * epsilon
+    elif scheme == 'central':
+        h = np.finfo(float).eps**(1./3) * np.maximum(np.abs(params), 1.)
+    else:
+        h = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(params), 1.)
+    if scheme != 'central':
+        f0 = evalFunc(params)
+    listPartials = []
+    for k in range(params.shape[-1]):
+        step = np.zeros_like(params)
+        step[..., k] = h[..., k]
+        hk = h[..., k, np.newaxis]
+        if scheme == 'central':
+            listPartials.append((evalFunc(params + step) - evalFunc(params - step)) / (2*hk))
+        else:
+            listPartials.append((evalFunc(params + step) - f0) / hk)
+    return np.stack(listPartials, axis=-1)
+
+
+# Robust loss functions rho(z) of the squared scaled residuals z = (r/lossScale)^2, as
+# defined in scipy.optimize.least_squares, so that the objective to be minimized is
+#     lossScale^2 * sum_i[ rho(z_i) ]
+# which is RSS for loss = 'linear'. Returns rho(z) and its derivative rho'(z), computed
+# element-wise on arrays of any shape
+def _robustLoss(z, loss):
+    if loss == 'linear':
+        return z, np.ones_like(z)
+    elif loss == 'soft_l1':
+        t = np.sqrt(1 + z)
+        return 2 * (t - 1), 1 / t
+    elif loss == 'huber':
+        t = np.sqrt(np.maximum(z, 1))
+        return np.where(z <= 1, z, 2 * t - 1), 1 / t
+    elif loss == 'cauchy':
+        return np.log1p(z), 1 / (1 + z)
+    elif loss == 'arctan':
+        return np.arctan(z), 1 / (1 + z**2)
+    else:
+        raise ValueError("loss needs to be one of 'linear', 'soft_l1', 'huber', 'cauchy' or 'arctan'!")
+
+
+# Flag the parameters lying on one of their bounds, up to numerical tolerance
+# bounds is a list of (lower, upper) tuples of scalars or of per-curve arrays
+# Returns a bool ndarray of the same shape as params
+def _paramsAtBound(params, bounds):
+    lower = np.stack(np.broadcast_arrays(*[np.asarray(-np.inf if lb is None else lb, dtype=float) for lb, _ in bounds]), axis=-1)
+    upper = np.stack(np.broadcast_arrays(*[np.asarray(np.inf if ub is None else ub, dtype=float) for _, ub in bounds]), axis=-1)
+    return np.isclose(params, lower, rtol=1e-6, atol=1e-8) | np.isclose(params, upper, rtol=1e-6, atol=1e-8)
+
+
+class lsqcurvefit(object):
     """Python class for non-linear least square fitting using scipy.optimize.minimize
 
        Features of this fitting class include:
        - fitting with lower/upper bounds and arbitrary equality/inequality constrains
        - weighted least square fitting (weight = 1/sigma^2)
-       - user-defined Jacobian for speed-up
+       - user-defined Jacobian for speed-up, picked up automatically for the models in fitfuns
        - choice of minimization algorithm (default=SLSQP). See Scipy documentation for the list
          of methods available
+       - choice of a trust-region non-linear least square backend working on the residual
+         vector (backend='least_squares') for bound-constrained problems, or of using it
+         automatically for problems without constraints other than bounds (backend='auto')
        - automatically handle missing data in x and y (nan, inf, -inf) and in sigma (nan)
        - constant parameters passing to model function
+       - fitting statistics computed lazily on first access, so that fits only needing
+         params and RSS skip them
        - auxiliary methods to show fitted curve against datapoints and print summary of
          fitting statistics
        - auxiliary method to parse fit parameters from file to pass to lsqcurvefit
@@ -42,8 +121,9 @@ class lsqcurvefit:
        fitObj = fitlib.lsqcurvefit(func, x, y, params0,
                                    jac=None, constants=None,
                                    bounds=None, constraints=(),
-                                   sigma=None, method='SLSQP',
-                                   maxiter=200, tol=None, epsilon=None, disp=True)
+                                   sigma=None, method='SLSQP', backend='minimize',
+                                   maxiter=200, tol=None, epsilon=None, finiteDiff='forward',
+                                   loss='linear', lossScale=1.0, disp=True)
 
        Required arguments:
        - func: callable
@@ -60,7 +140,8 @@ class lsqcurvefit:
        - jac: callable
            Jacobian (gradient) of model function. Must take the same arguments as func() and
            return a 2D-ndarray of shape=(M, N) where M is the number of datapoints and N is the
-           number of parameters
+           number of parameters. If None, the Jacobian registered for func in fitfuns is used
+           if there is one. Set to False to always compute the Jacobian numerically
            (default=None)
        - constants: sequence
            Constant parameter(s) to be passed to func() as func(params, x, constants)
@@ -81,15 +162,47 @@ class lsqcurvefit:
            weight = 1/sigma^2
            (default=None)
        - method: str
-           Type of solver. See documentation for scipy.optimize.minimize for details
+           Type of solver. See documentation for scipy.optimize.minimize for details. With
+           backend='least_squares', one of 'trf', 'dogbox' or 'lm' (see documentation for
+           scipy.optimize.least_squares); 'trf' is used if a minimize method is given
            (default='SLSQP')
+       - backend: str
+           'minimize' to minimize RSS with scipy.optimize.minimize, or 'least_squares' to
+           solve the non-linear least square problem directly from the residual vector and
+           the Jacobian of func with scipy.optimize.least_squares, which needs far fewer
+           function evaluations. Constraints other than bounds are not supported by
+           'least_squares'. 'auto' uses 'least_squares' for problems without constraints other
+           than bounds when method is SLSQP, TNC, L-BFGS-B, trf, dogbox or lm, and 'minimize'
+           otherwise. With 'least_squares', status is mapped to the meaning it has with
+           'minimize' (0 = success, 1 = maximum number of function evaluations reached,
+           -1 = improper input) and the status of optimize.least_squares is kept as lsqStatus,
+           and nit is None since least_squares does not count iterations (see nfev instead)
+           (default='minimize')
        - maxiter: int
-           Maximum number of iterations to perform
+           Maximum number of iterations to perform (maximum number of function evaluations
+           with backend='least_squares')
            (default=200)
        - tol: float
            Tolerance for termination
        - epsilon: float
            Step size used for numerical approximation of the jacobian of the model function
+           (default=machine eps^(1/2) for forward or eps^(1/3) for central, times max(|p|, 1))
+       - finiteDiff: str
+           'forward' or 'central' finite differences for the numerical approximation of the
+           jacobian of the model function, which perturbs each parameter once (twice for
+           'central') over all datapoints at the same time
+           (default='forward')
+       - loss: str
+           Loss function of the residuals, 'linear' for least squares, or one of the robust
+           losses 'soft_l1', 'huber', 'cauchy' and 'arctan' (see documentation for
+           scipy.optimize.least_squares) to limit the influence of outlier datapoints in a
+           single fit. RSS and the fitting statistics are still computed from the squared
+           residuals
+           (default='linear')
+       - lossScale: float
+           Scale of the residuals beyond which datapoints are treated as outliers by the
+           robust losses, in units of y (or of sigma if sigma is given)
+           (default=1.0)
        - disp: bool
            Set to True to print convergence messages
            (default=True)
@@ -103,6 +216,18 @@ class lsqcurvefit:
        - paramNames: names of the parameters to display
 
 
+    To compute bootstrap confidence intervals of the fitted parameters:
+
+       paramLBs, paramUBs = fitObj.bootstrapCI(numSamples=1000, alpha=0.05)
+
+       Optional arguments:
+       - numSamples: number of bootstrap resamples
+       - alpha: 100*(1-alpha)% CIs are computed
+
+       Also available as fitObj.paramLBs and fitObj.paramUBs, computed on first access with
+       the default settings
+
+
     To plot:
 
        ax = fitObj.plot(figsize=(7.5, 7.5), numPlotPoints=500, norm=False,
@@ -200,8 +325,9 @@ class lsqcurvefit:
     def __init__(self, func, x, y, params0,
                  jac=None, constants=None,
                  bounds=None, constraints=(),
-                 sigma=None, method='SLSQP',
-                 maxiter=200, tol=None, epsilon=None, disp=True):
+                 sigma=None, method='SLSQP', backend='minimize',
+                 maxiter=200, tol=None, epsilon=None, finiteDiff='forward',
+                 loss='linear', lossScale=1.0, disp=True):
 
         # Convert x, y, sigma to numpy array, get ride of missing data
         # in x, y and sigma and assign them to instance variables
@@ -224,7 +350,10 @@ class lsqcurvefit:
         self.DOF = self.nDataPoints - self.nParams
         self.func = func
         self.params0 = np.array(params0)
-        self.funcPrime = jac
+        if jac is None:
+            self.funcPrime = fitfuns.getJacobian(func)
+        else:
+            self.funcPrime = jac
         self.constants = constants
         if bounds:
             self.bounds = bounds
@@ -232,54 +361,80 @@ class lsqcurvefit:
             self.bounds = [(None, None)] * self.nParams
         self.constraints = constraints
         self.method = method
+        self.backend = self._chooseBackend(backend)
         self.maxiter = maxiter
         self.tol = tol
         self.epsilon = epsilon
+        self.finiteDiff = finiteDiff
+        self.loss = loss
+        self.lossScale = lossScale
         self.disp = disp
 
         # Sanity check of input parameters
         self._sanityCheck()
 
-        # Call optimize.minimize to fit
+        # Call optimize.minimize or optimize.least_squares to fit
+        startTime = time.time()
         results = self._fit()
+        self.fitTime = time.time() - startTime
 
         # Assign some results as instance variables
         self.status = results.status
         self.success = results.success
         self.message = results.message
+        self.nfev = results.get('nfev')
+        self.njev = results.get('njev')
+        self.lsqStatus = None
 
         self.params = results.x
-        self.RSS = results.fun
 
-        try:
-            self.jacobianRSS = results.jac
-        except AttributeError:
-            self.jacobianRSS = None
-
-        try:
-            self.nit = results.nit
-        except AttributeError:
+        if self.backend == 'least_squares':
+            # least_squares returns cost = RSS/2 (with a linear loss) and grad = J^T r = (dRSS/dp)/2,
+            # and does not count iterations
+            # Its status (1 to 4 = converged on one of the tolerances, 0 = max_nfev reached,
+            # -1 = improper input) is mapped to 0 = success as with optimize.minimize
+            if self.loss == 'linear':
+                self.RSS = 2 * results.cost
+            else:
+                self.RSS = np.sum(results.fun**2)
+            self.jacobianRSS = 2 * results.grad
             self.nit = None
+            self.lsqStatus = results.status
+            if results.status > 0:
+                self.status = 0
+            elif results.status == 0:
+                self.status = 1
+            else:
+                self.status = -1
+            # The residuals and, with a linear loss, the Jacobian of the residuals at the
+            # solution are by-products of least_squares, so statistics need no new evaluation
+            # The rows of datapoints with an infinite sigma (zero weight) are zero in the
+            # Jacobian of the residuals, so the Jacobian of func is then computed again
+            self.residuals = results.fun
+            if self.loss == 'linear':
+                if self.sigma is None:
+                    self.jacobianFunc = results.jac
+                elif np.all(np.isfinite(self.sigma)):
+                    self.jacobianFunc = results.jac * self.sigma[:, np.newaxis]
+        else:
+            if self.loss == 'linear':
+                self.RSS = results.fun
+            else:
+                self.RSS = self._compute_RSS(self.params, self.x, self.y, self.func, None, self.constants, self.sigma)
+
+            try:
+                self.jacobianRSS = results.jac
+            except AttributeError:
+                self.jacobianRSS = None
 
-        # Compute the Jacobian of func at params that minimizes RSS
-        self.jacobianFunc = self._compute_jacobianFunc()
-
-        # Compute fitting statistics: (see methods for formulas)
-
-        # Compute R-squared
-        self.R2 = self._compute_Rsquared()
-        # Compute adjusted R-squared
-        self.adjR2 = self._compute_adjustedRsquared()
-        # Compute reduced Chi-squared/residual variance/mean square error
-        self.reChi2 = self._compute_reducedChiSquared()
-        # Compute standard error of the regression/standard error of the equation
-        self.SER = self._compute_standardErrorRegression()
-        # Compute standard errors of the fit parameters
-        self.paramSEs = self._compute_paramSEs()
-        # Compute parameters' t-statistic
-        self.paramTvals = self._compute_tStatistic()
-        # Compute parameters' p-values
-        self.paramPvals = self._compute_pValuesFromT()
+            try:
+                self.nit = results.nit
+            except AttributeError:
+                self.nit = None
+
+        # The Jacobian of func at params that minimizes RSS and the fitting statistics
+        # (R2, adjR2, reChi2, SER, paramSEs, paramTvals, paramPvals) are computed
+        # lazily on first access. See the lazy attributes after the _compute methods
 
         del disp
 
@@ -287,21 +442,115 @@ class lsqcurvefit:
     def _sanityCheck(self):
         if len(self.x) != len(self.y):
             raise ValueError("x and y need to be the same length!")
+        if self.backend not in ['minimize', 'least_squares']:
+            raise ValueError("backend needs to be either 'auto', 'minimize' or 'least_squares'!")
+        if self.backend == 'least_squares' and self.constraints:
+            raise ValueError("Constraints other than bounds are not supported by the least_squares backend!")
+        if self.finiteDiff not in ['forward', 'central']:
+            raise ValueError("finiteDiff needs to be either 'forward' or 'central'!")
+        if self.loss not in ['linear', 'soft_l1', 'huber', 'cauchy', 'arctan']:
+            raise ValueError("loss needs to be one of 'linear', 'soft_l1', 'huber', 'cauchy' or 'arctan'!")
+
+    # Route problems with bounds only, which SLSQP/TNC/L-BFGS-B would solve by minimizing
+    # RSS as a general scalar function, to the bounded least square solver
+    # Problems with real constraints, methods that ignore bounds, and parameters fixed by
+    # equal lower and upper bounds are left to optimize.minimize
+    def _chooseBackend(self, backend):
+        if backend != 'auto':
+            return backend
+        isFixed = [lower is not None and upper is not None and lower >= upper for lower, upper in self.bounds]
+        if (not self.constraints and not any(isFixed) and
+                self.method in ['SLSQP', 'TNC', 'L-BFGS-B', 'trf', 'dogbox', 'lm']):
+            return 'least_squares'
+        else:
+            return 'minimize'
 
-    # Main method to fit curves using optimize.minimize, default method = SLSQP
+    # Main method to fit curves using optimize.minimize, default method = SLSQP,
+    # or optimize.least_squares if backend = 'least_squares'
     def _fit(self):
 
+        if self.backend == 'least_squares':
+            return self._fitLeastSquares()
+
+        if self.loss == 'linear':
+            objective = self._compute_RSS
+            objectivePrime = self._compute_RSSprime
+        else:
+            objective = self._compute_robustCost
+            objectivePrime = self._compute_robustCostPrime
         if self.funcPrime:
-            RSSprime = self._compute_RSSprime
+            RSSprime = objectivePrime
         else:
             RSSprime = None
 
-        return optimize.minimize(self._compute_RSS, self.params0,
+        return optimize.minimize(objective, self.params0,
                                  args=(self.x, self.y, self.func, self.funcPrime, self.constants, self.sigma),
                                  bounds=self.bounds, constraints=self.constraints, jac=RSSprime,
                                  method=self.method,
                                  tol=self.tol, options={'maxiter': self.maxiter, 'disp': self.disp})
 
+    # Fit curves using optimize.least_squares, default method = trf
+    # Bounds are converted from a list of (lower, upper) tuples to the (lowers, uppers)
+    # form expected by optimize.least_squares
+    def _fitLeastSquares(self):
+
+        if self.funcPrime:
+            residualsPrime = self._compute_residualsPrime
+        elif self.finiteDiff == 'central':
+            residualsPrime = '3-point'
+        else:
+            residualsPrime = '2-point'
+
+        if self.method in ['trf', 'dogbox', 'lm']:
+            method = self.method
+        else:
+            method = 'trf'
+
+        lowerBounds = [-np.inf if lower is None else lower for lower, _ in self.bounds]
+        upperBounds = [np.inf if upper is None else upper for _, upper in self.bounds]
+        if method == 'lm' and (np.isfinite(lowerBounds).any() or np.isfinite(upperBounds).any() or self.loss != 'linear'):
+            method = 'trf'
+
+        if self.tol is None:
+            tolDict = {}
+        else:
+            tolDict = {'ftol': self.tol, 'xtol': self.tol, 'gtol': self.tol}
+
+        # Unlike SLSQP, least_squares requires the initial guess to be within bounds
+        params0 = np.clip(self.params0.astype(float), lowerBounds, upperBounds)
+
+        return optimize.least_squares(self._compute_residuals, params0, jac=residualsPrime,
+                                      bounds=(lowerBounds, upperBounds), method=method,
+                                      loss=self.loss, f_scale=self.lossScale,
+                                      max_nfev=self.maxiter, verbose=int(bool(self.disp)),
+                                      args=(self.x, self.y, self.func, self.funcPrime, self.constants, self.sigma),
+                                      **tolDict)
+
+    # Residual vector to be minimized in the least square sense by optimize.least_squares.
+    # Compute func(p,x_i)-y_i or, if sigma is given, (func(p,x_i)-y_i)/sigma_i
+    # (i.e. the fitfuns *Residual functions, generalized to any func and to weights)
+    def _compute_residuals(self, params, x, y, func, _, constants=None, sigma=None):
+        if constants is None:
+            argsList = [params, x]
+        else:
+            argsList = [params, x, constants]
+        if sigma is None:
+            return func(*argsList) - y
+        else:
+            return (func(*argsList) - y)/sigma
+
+    # Jacobian of the residual vector, i.e. the Jacobian of func, divided by sigma_i
+    # if sigma is given
+    def _compute_residualsPrime(self, params, x, y, func, funcPrime, constants=None, sigma=None):
+        if constants is None:
+            argsList = [params, x]
+        else:
+            argsList = [params, x, constants]
+        if sigma is None:
+            return funcPrime(*argsList)
+        else:
+            return funcPrime(*argsList) / sigma[:, np.newaxis]
+
     # Objective function (residual sum of squares) to be minimized.
     # Compute sum_i[ (func(p,x_i)-y_i)^2 ] or, if sigma is given,
     # sum_i[ w_i*(func(p,x_i)-y_i)^2 ] where w_i = 1/sigma_i^2
@@ -329,6 +578,20 @@ class lsqcurvefit:
         else:
             return np.sum(2 * (func(*argsList) - y) * funcPrime(*argsList).transpose() / sigma**2, axis=1)
 
+    # Objective function with a robust loss, to be minimized instead of RSS if loss is
+    # not 'linear'. Compute lossScale^2 * sum_i[ rho((r_i/lossScale)^2) ] where r_i are
+    # the residuals (divided by sigma_i if sigma is given)
+    def _compute_robustCost(self, params, *args):
+        r = self._compute_residuals(params, *args)
+        return self.lossScale**2 * np.sum(_robustLoss((r/self.lossScale)**2, self.loss)[0])
+
+    # Derivative of the objective function with a robust loss, i.e.
+    # 2 * sum_i[ rho'((r_i/lossScale)^2) * r_i * dr_i/dp ]
+    def _compute_robustCostPrime(self, params, *args):
+        r = self._compute_residuals(params, *args)
+        rho1 = _robustLoss((r/self.lossScale)**2, self.loss)[1]
+        return 2 * np.dot(rho1 * r, self._compute_residualsPrime(params, *args))
+
     # Compute the Jacobian of func at params that minimizes RSS
     # Use user-supplied Jacobian if provided, otherwise compute numerically
     def _compute_jacobianFunc(self):
@@ -338,20 +601,25 @@ class lsqcurvefit:
             else:
                 return self.funcPrime(self.params, self.x, self.constants)
         else:
-            if self.epsilon:
-                eps = self.epsilon
-            else:
-                eps = np.sqrt(np.finfo(np.float).eps)
             if self.constants is None:
-                return np.array([optimize.approx_fprime(self.params, self.func, eps, xi) for xi in self.x])
+                evalFunc = lambda params: self.func(params, self.x)
             else:
-                return np.array([optimize.approx_fprime(self.params, self.func, eps, xi, self.constants) for xi in self.x])
+                evalFunc = lambda params: self.func(params, self.x, self.constants)
+            return _finiteDiffJacobian(evalFunc, self.params, self.epsilon, self.finiteDiff)
+
+    # Compute the residuals at params that minimizes RSS, if not kept from the fit
+    def _compute_fittedResiduals(self):
+        return self._compute_residuals(self.params, self.x, self.y, self.func, None, self.constants, self.sigma)
 
-    # Compute R-squared
+    # Compute R-squared from RSS and the residuals r_i at params that minimizes RSS, as
+    #     SStot = sum_i[ (func(p,x_i)-mean(y))^2 ] = sum_i[ (r_i+y_i-mean(y))^2 ]
+    # (with each term divided by sigma_i^2 if sigma is given), without evaluating func again
     def _compute_Rsquared(self):
-        SSres = self._compute_RSS(self.params, self.x, self.y, self.func, None, self.constants, self.sigma)
-        SStot = self._compute_RSS(self.params, self.x, np.mean(self.y), self.func, None, self.constants, self.sigma)
-        return 1 - SSres/SStot
+        if self.sigma is None:
+            SStot = np.sum((self.residuals + self.y - np.mean(self.y))**2)
+        else:
+            SStot = np.sum((self.residuals + (self.y - np.mean(self.y))/self.sigma)**2)
+        return 1 - self.RSS/SStot
 
     # Compute adjusted R-squared
     def _compute_adjustedRsquared(self):
@@ -402,6 +670,78 @@ class lsqcurvefit:
     def _compute_pValuesFromT(self):
         return stats.t.sf(np.abs(self.paramTvals), self.DOF)*2
 
+    # Public method to compute bootstrap confidence intervals of the fitted parameters
+    def bootstrapCI(self, numSamples=1000, alpha=0.05):
+        """Return bootstrap estimates of the 100*(1-alpha)% CIs of the fitted parameters
+        as (lower bounds, upper bounds), also assigned to paramLBs and paramUBs.
+        Resamples are drawn as a single index matrix (as in liblib.bootstrap) and fitted
+        all at once with batchcurvefit starting from params, with the same Jacobian,
+        tolerance and loss as the fit. Resamples of fits with constraints other than bounds
+        are fitted one by one with lsqcurvefit and the same solver options instead
+        """
+        n = len(self.y)
+        idx = np.random.randint(0, n, (numSamples, n))
+        if self.sigma is None:
+            sigma = None
+        else:
+            sigma = self.sigma[idx]
+        if self.constraints:
+            listBootParams = []
+            for i in range(numSamples):
+                bootFitObj = lsqcurvefit(self.func, self.x[idx[i]], self.y[idx[i]], self.params,
+                                         jac=self.funcPrime, constants=self.constants,
+                                         bounds=self.bounds, constraints=self.constraints,
+                                         sigma=None if sigma is None else sigma[i],
+                                         method=self.method, backend=self.backend,
+                                         maxiter=self.maxiter, tol=self.tol, epsilon=self.epsilon,
+                                         finiteDiff=self.finiteDiff, loss=self.loss,
+                                         lossScale=self.lossScale, disp=False)
+                if bootFitObj.success:
+                    listBootParams.append(bootFitObj.params)
+            bootParams = np.array(listBootParams).reshape(-1, self.nParams)
+        else:
+            bootFitObj = batchcurvefit(self.func, self.x[idx], self.y[idx], self.params,
+                                       jac=self.funcPrime, constants=self.constants,
+                                       bounds=self.bounds, sigma=sigma,
+                                       maxiter=self.maxiter, tol=self.tol, epsilon=self.epsilon,
+                                       finiteDiff=self.finiteDiff, loss=self.loss,
+                                       lossScale=self.lossScale)
+            bootParams = bootFitObj.params[bootFitObj.success]
+        if len(bootParams) == 0:
+            self.paramLBs = np.ones(self.nParams) * np.nan
+            self.paramUBs = np.ones(self.nParams) * np.nan
+        else:
+            self.paramLBs, self.paramUBs = np.percentile(bootParams, [100*alpha/2, 100*(1-alpha/2)], axis=0)
+        return self.paramLBs, self.paramUBs
+
+    # Compute the lower/upper bounds of the bootstrap CIs with the default settings
+    def _compute_paramLBs(self):
+        return self.bootstrapCI()[0]
+
+    def _compute_paramUBs(self):
+        return self.bootstrapCI()[1]
+
+    # Flag the fitted parameters lying on one of their bounds
+    def _compute_atBound(self):
+        return _paramsAtBound(self.params, self.bounds)
+
+    # Lazily computed Jacobian and fitting statistics
+    residuals = _lazyattr('residuals', _compute_fittedResiduals)
+    jacobianFunc = _lazyattr('jacobianFunc', _compute_jacobianFunc)
+    R2 = _lazyattr('R2', _compute_Rsquared)
+    adjR2 = _lazyattr('adjR2', _compute_adjustedRsquared)
+    reChi2 = _lazyattr('reChi2', _compute_reducedChiSquared)
+    SER = _lazyattr('SER', _compute_standardErrorRegression)
+    paramSEs = _lazyattr('paramSEs', _compute_paramSEs)
+    paramTvals = _lazyattr('paramTvals', _compute_tStatistic)
+    paramPvals = _lazyattr('paramPvals', _compute_pValuesFromT)
+    paramLBs = _lazyattr('paramLBs', _compute_paramLBs)
+    paramUBs = _lazyattr('paramUBs', _compute_paramUBs)
+    logL = _lazyattr('logL', lambda self: logLikelihood(self.RSS, self.nDataPoints))
+    AIC = _lazyattr('AIC', lambda self: AIC(self.RSS, self.nDataPoints, self.nParams))
+    BIC = _lazyattr('BIC', lambda self: BIC(self.RSS, self.nDataPoints, self.nParams))
+    atBound = _lazyattr('atBound', _compute_atBound)
+
     # Make summary text in plot
     def _makeSummaryInPlot(self, paramNames=None):
         if paramNames:
@@ -446,7 +786,10 @@ class lsqcurvefit:
         print "Standard error of regression = {:.6g}".format(self.SER)
         print "R-squared = {:.6g}".format(self.R2)
         print "Adjusted R-squared = {:.6g}".format(self.adjR2)
-        print "Number of iterations to convergence = {:d}".format(self.nit)
+        if self.nit is None:
+            print "Number of function evaluations to convergence = {:d}".format(self.nfev)
+        else:
+            print "Number of iterations to convergence = {:d}".format(self.nit)
 
     # Public method to plot data and fitted curve
     def plot(self, figsize=(7.5, 7.5), numPlotPoints=500, norm=False,
@@ -455,10 +798,14 @@ class lsqcurvefit:
              xlabel=None, ylabel=None, title=None, xlim=None, ylim=None,
              fontsize=None, summaryfontsize=18, labelfontsize=20, tickfontsize=20,
              summary=True, paramNames=None,
-             _label=None, _useCurrFig=False):
+             _label=None, _useCurrFig=False, _fittedCurve=None):
         """Plot the fitted curve against the datapoints """
-        # Compute the x axis points for plotting the fitted line
-        xPlotPoints = np.arange(min(self.x), max(self.x)+1, float(max(self.x)-min(self.x))/numPlotPoints)
+        # Compute the x axis points for plotting the fitted line, unless precomputed
+        # along with the fitted line
+        if _fittedCurve is None:
+            xPlotPoints = self._plotPoints(numPlotPoints)
+        else:
+            xPlotPoints, yPlotPoints = _fittedCurve
 
         # Make figure
         if not _useCurrFig:
@@ -483,7 +830,9 @@ class lsqcurvefit:
         # Plot the data and fitted line
         plt.plot(self.x, self.y/normFactor, marker='o', linestyle='None', color='w',
                  markeredgecolor=markeredgecolor, markeredgewidth=markeredgewidth, markersize=markersize)
-        plt.plot(xPlotPoints, self.func(*funcArgsList)/normFactor,
+        if _fittedCurve is None:
+            yPlotPoints = self.func(*funcArgsList)
+        plt.plot(xPlotPoints, yPlotPoints/normFactor,
                  color=linecolor, linewidth=linewidth, label=_label)
         ax = plt.gca()
 
@@ -533,6 +882,35 @@ class lsqcurvefit:
 
         return ax
 
+    # Compute the x axis points for plotting the fitted line
+    def _plotPoints(self, numPlotPoints):
+        return np.arange(min(self.x), max(self.x)+1, float(max(self.x)-min(self.x))/numPlotPoints)
+
+    # Static method to evaluate the fitted lines of multiple fitObj with a single call of
+    # their model function, if they share a model of fitfuns (which accepts batches of
+    # parameters) and its constants
+    # Returns a list of (xPlotPoints, yPlotPoints), or None otherwise
+    @staticmethod
+    def _fittedCurves(listFitObj, numPlotPoints):
+        func = listFitObj[0].func
+        constants = listFitObj[0].constants
+        if fitfuns.models.get(getattr(func, '__name__', None), {}).get('func') is not func:
+            return None
+        for fitObj in listFitObj:
+            if fitObj.func is not func or (fitObj.constants is None) != (constants is None):
+                return None
+            if constants is not None and not np.array_equal(fitObj.constants, constants):
+                return None
+        listXPlotPoints = [fitObj._plotPoints(numPlotPoints) for fitObj in listFitObj]
+        maxLen = max(len(xPlotPoints) for xPlotPoints in listXPlotPoints)
+        X = np.array([np.pad(xPlotPoints, (0, maxLen-len(xPlotPoints)), 'edge') for xPlotPoints in listXPlotPoints])
+        params = np.array([fitObj.params for fitObj in listFitObj])
+        if constants is None:
+            Y = func(params, X)
+        else:
+            Y = func(params, X, constants)
+        return [(xPlotPoints, Y[i, :len(xPlotPoints)]) for i, xPlotPoints in enumerate(listXPlotPoints)]
+
     # Static method to plot multiple fitObj in the same plot
     @staticmethod
     def plotMultiple(listFitObj, figsize=(7.5, 7.5), colormap='gist_rainbow',
@@ -544,12 +922,18 @@ class lsqcurvefit:
         kwargs.pop('linecolor', None)
         kwargs.pop('markeredgecolor', None)
         kwargs.pop('_label', None)
+        kwargs.pop('_fittedCurve', None)
 
         # Initialize
         nFitObj = len(listFitObj)
         if not listLabel:
             listLabel = [None] * nFitObj
 
+        # Evaluate all fitted lines at once if possible
+        listFittedCurve = lsqcurvefit._fittedCurves(listFitObj, kwargs.get('numPlotPoints', 500))
+        if listFittedCurve is None:
+            listFittedCurve = [None] * nFitObj
+
         # Define color map
         cm = plt.get_cmap(colormap)
 
@@ -560,7 +944,7 @@ class lsqcurvefit:
         # Plot all fitObjs
         for i in range(nFitObj):
             ax = listFitObj[i].plot(linecolor=cm(1.*i/nFitObj), markeredgecolor=cm(1.*i/nFitObj),
-                                    _label=listLabel[i], **kwargs)
+                                    _label=listLabel[i], _fittedCurve=listFittedCurve[i], **kwargs)
 
         # Show legend if requested
         if any(listLabel):
@@ -648,50 +1032,1450 @@ class lsqcurvefit:
     @staticmethod
     def parseFitParamFromFile(fitParamFilePath):
         """Parse the fit parameters to be passed to lsqcurvefit from a file"""
-        # Define default values for the fit parameters that will be passed to the fit function
-        # This should be updated when new argument is added to fitlib.lsqcurvefit()
-        fitParamDict = {'func': None,
-                        'params0': None,
-                        'jac': None,
-                        'constants': None,
-                        'bounds': None,
-                        'constraints': (),
-                        'sigma': None,
-                        'method': 'SLSQP',
-                        'maxiter': 200,
-                        'tol': None,
-                        'epsilon': None,
-                        'disp': False,
-                        'x': None,
-                        'outputAttrs': ['params']}
-
-        # Import fit parameters from fitParamFile
-        (fitParamDir, fitParamFilename) = os.path.split(fitParamFilePath)
-        (fitParamFileBasename, _) = os.path.splitext(fitParamFilename)
-
-        sys.path.insert(0, fitParamDir)
-        fitParam = __import__(fitParamFileBasename)
-
-        # Assign fit parameters read from fitParamFile into fitParamDict
-        # and detach x and outputAttrs from fitParamDict
-        userDefinedFitParamDict = {property_: value
-                                   for property_, value in vars(fitParam).iteritems()
-                                   if property_[:2] != '__' and not isinstance(value, ModuleType)}
-        fitParamDict.update(userDefinedFitParamDict)
-        x = fitParamDict.pop('x')
-        outputAttrs = fitParamDict.pop('outputAttrs')
+        spec = fitspec.fromFile(fitParamFilePath)
+        fitParamDict = dict(spec.fitParamDict)
+        x = spec.x
+        outputAttrs = spec.outputAttrs
 
         return fitParamDict, x, outputAttrs
 
 
+class batchcurvefit(object):
+    """Python class for non-linear least square fitting of many curves at once using a
+       vectorized Levenberg-Marquardt algorithm
+
+       All N curves are fitted simultaneously: the model function is evaluated once per
+       iteration on the whole (N, M) batch and the N normal equations are solved as a
+       stack, instead of calling scipy.optimize.minimize N times.
+
+       Features of this fitting class include:
+       - fitting with lower/upper bounds (projected Levenberg-Marquardt with a trust radius
+         scaled by |params|)
+       - weighted least square fitting (weight = 1/sigma^2)
+       - x shared by all curves or given per curve
+       - params0 shared by all curves or given per curve
+       - user-defined Jacobian for speed-up, or vectorized numerical Jacobian otherwise
+       - automatically handle missing data in x and y (nan, inf, -inf) and in sigma (nan)
+       - y and sigma stored as float32 if given as float32 (mixed precision), with all the
+         computations of the solver done in float64
+       - constant parameters passing to model function
+       - the same fitting statistics as lsqcurvefit, returned as arrays with one row per curve
+
+
+    Usages:
+
+    To fit:
+
+       batchFitObj = fitlib.batchcurvefit(func, x, y, params0,
+                                          jac=None, constants=None, bounds=None,
+                                          sigma=None, maxiter=200, tol=None, epsilon=None,
+                                          finiteDiff='forward', loss='linear', lossScale=1.0)
+
+       Required arguments:
+       - func: callable
+           Model function to be fitted to the data. Must take the form of func(params, x) or
+           func(params, x, constants) if constant parameters are defined, and must broadcast:
+           params[i] is passed as an (N, 1) column holding the i-th parameter of every curve,
+           and x as either an M-length or an (N, M) array. func must then return an (N, M)
+           array. Most models in fitfuns satisfy this as written
+       - x: M-length sequence or (N, M) array
+           Independent variable to be passed to func(), shared by all curves or per curve
+       - y: (N, M) array
+           Dependent data, one curve per row
+       - params0: P-length sequence or (N, P) array
+           Initial guess for the parameters, shared by all curves or per curve
+
+       Optional arguments:
+       - jac: callable
+           Jacobian of model function. Must take the same arguments as func() and return a
+           3D-ndarray of shape=(N, M, P). If None, the Jacobian registered for func in fitfuns
+           is used if there is one. Set to False to always compute the Jacobian numerically
+           (default=None)
+       - constants: sequence
+           Constant parameter(s) to be passed to func() as func(params, x, constants)
+           (default=None)
+       - bounds: P-length sequence of tuples
+           A list of tuples specifying the lower and upper bound for each parameter
+           [(pl0, pu0),(pl1, pu1),...]. Use None for one of min or max when there is no bound
+           in that direction. Each bound can also be an N-length array to give different
+           bounds to each curve
+           (default=None)
+       - sigma: M-length sequence or (N, M) array
+           If provided, these values are used in weighted least-squares fitting where
+           weight = 1/sigma^2
+           (default=None)
+       - maxiter: int
+           Maximum number of iterations to perform
+           (default=200)
+       - tol: float
+           Relative tolerance on the decrease of RSS and on the step size for termination
+           (default=1.49012e-8)
+       - epsilon: float
+           Step size used for numerical approximation of the jacobian of the model function
+           (default=machine eps^(1/2) for forward or eps^(1/3) for central, times max(|p|, 1))
+       - finiteDiff: str
+           'forward' or 'central' finite differences for the numerical approximation of the
+           jacobian of the model function
+           (default='forward')
+       - loss: str
+           Loss function of the residuals, 'linear' for least squares, or one of the robust
+           losses 'soft_l1', 'huber', 'cauchy' and 'arctan' as in lsqcurvefit. Robust losses
+           are minimized by iteratively reweighting the normal equations of all curves at
+           once. RSS and the fitting statistics are still computed from the squared residuals
+           (default='linear')
+       - lossScale: float
+           Scale of the residuals beyond which datapoints are treated as outliers by the
+           robust losses
+           (default=1.0)
+
+       Attributes after fitting (N = number of curves, P = number of parameters):
+       - params, paramSEs, paramTvals, paramPvals: (N, P) arrays
+       - paramLBs, paramUBs: (N, P) arrays of bootstrap CIs, computed on first access with
+         the default settings of bootstrapCI(numSamples=1000, alpha=0.05, maxBatchSize=100000)
+       - residuals: (N, M) array of the weighted residuals at the solution (0 at missing
+         data), kept from the last iteration so that R2 needs no new evaluation of func
+       - RSS, R2, adjR2, reChi2, SER, nDataPoints, DOF, nit, status, success: N-length arrays
+       - nfev, njev: N-length arrays of the numbers of evaluations of func and of its Jacobian
+       - batchFitTime: fitting time of the whole batch. fitTime is None since the curves are
+         fitted together, and is left out of the telemetry of fitresults
+       - atBound: (N, P) bool array flagging the parameters ending on one of their bounds
+       - message: N-length array describing the status of each curve
+       - status: 1 = converged, 2 = no further improvement possible,
+                 3 = maxiter reached, 4 = stalled on a plateau of the model (a parameter
+                 without effect on the model values, e.g. after an unbounded parameter walked
+                 off towards infinity), -1 = not fitted (fewer valid datapoints than parameters
+                 or invalid params0). Only 1 and 2 count as success
+    """
+
+    # Constructor which also does fitting
+    def __init__(self, func, x, y, params0,
+                 jac=None, constants=None, bounds=None,
+                 sigma=None, maxiter=200, tol=None, epsilon=None, finiteDiff='forward',
+                 loss='linear', lossScale=1.0):
+
+        # Convert x, y, sigma to numpy array, mask missing data in x, y and sigma
+        # and assign them to instance variables
+        # y and sigma given as float32 are stored as float32 to halve the memory footprint
+        # of large batches; all computations are done in float64
+        storageType = np.float32 if np.asarray(y).dtype == np.float32 else float
+        y_np = np.array(y, dtype=storageType, ndmin=2)
+        x_np = np.array(x, dtype=float)
+        self.nCurves, nCols = y_np.shape
+
+        isFiniteBoolArray = np.isfinite(x_np) & np.isfinite(y_np)
+        if sigma is None:
+            sigma_np = np.ones(1, dtype=storageType)
+        else:
+            sigma_np = np.array(sigma, dtype=storageType)
+            isFiniteBoolArray = isFiniteBoolArray & ~np.isnan(sigma_np)  # Note the use of ~isnan instead of isfinite to allow the use of 1/inf weight
+        self.mask = isFiniteBoolArray
+
+        # Missing x are replaced by a valid x of the same curve so that func stays finite;
+        # they do not contribute to the fit since their weight is set to zero
+        if np.all(np.isfinite(x_np)):
+            self.x = x_np
+        else:
+            xFill = np.max(np.where(np.isfinite(x_np), x_np, -np.inf), axis=-1)
+            xFill = np.where(np.isfinite(xFill), xFill, 1.)
+            self.x = np.where(np.isfinite(x_np), x_np, np.expand_dims(xFill, -1))
+        self.y = np.where(self.mask, y_np, 0.)
+        self.weights = np.where(self.mask, 1/np.where(self.mask, sigma_np, 1.), 0.).astype(storageType, copy=False)
+
+        # Assign instance variables
+        self.nDataPoints = np.sum(self.mask, axis=1)
+        self.params0 = np.array(params0, dtype=float)
+        self.nParams = self.params0.shape[-1]
+        self.DOF = self.nDataPoints - self.nParams
+        self.func = func
+        if jac is None:
+            self.funcPrime = fitfuns.getJacobian(func)
+        else:
+            self.funcPrime = jac
+        self.constants = constants
+        if bounds:
+            self.bounds = bounds
+        else:
+            self.bounds = [(None, None)] * self.nParams
+        self.sigma = sigma
+        self.maxiter = maxiter
+        if tol is None:
+            self.tol = 1.49012e-8
+        else:
+            self.tol = tol
+        self.epsilon = epsilon
+        self.finiteDiff = finiteDiff
+        self.loss = loss
+        self.lossScale = lossScale
+
+        # Sanity check of input parameters
+        self._sanityCheck(nCols)
+
+        # Fit all curves, and report the fitting time of the whole batch
+        # The curves are fitted together, so there is no fitting time per curve
+        startTime = time.time()
+        self._fit()
+        self.batchFitTime = time.time() - startTime
+        self.fitTime = None
+
+        # The Jacobian of func at params that minimizes RSS and the fitting statistics
+        # are computed lazily on first access (see lsqcurvefit for formulas)
+
+    # Sanity check of input parameters
+    def _sanityCheck(self, nCols):
+        if self.x.shape[-1] != nCols:
+            raise ValueError("x and y need to have the same number of datapoints per curve!")
+        if self.x.ndim == 2 and self.x.shape[0] != self.nCurves:
+            raise ValueError("x needs to be either 1D or have the same number of rows as y!")
+        if self.params0.ndim == 2 and self.params0.shape[0] != self.nCurves:
+            raise ValueError("params0 needs to be either 1D or have the same number of rows as y!")
+        if len(self.bounds) != self.nParams:
+            raise ValueError("bounds need to have the same length as params0!")
+        if self.finiteDiff not in ['forward', 'central']:
+            raise ValueError("finiteDiff needs to be either 'forward' or 'central'!")
+        if self.loss not in ['linear', 'soft_l1', 'huber', 'cauchy', 'arctan']:
+            raise ValueError("loss needs to be one of 'linear', 'soft_l1', 'huber', 'cauchy' or 'arctan'!")
+
+    # Evaluate func for the curves indexed by idx with params of shape (len(idx), nParams)
+    # Returns a 2D-ndarray of shape (len(idx), M)
+    def _evalFunc(self, params, idx):
+        x = self.x if self.x.ndim == 1 else self.x[idx]
+        paramCols = params.T[:, :, np.newaxis]
+        if self.constants is None:
+            f = self.func(paramCols, x)
+        else:
+            f = self.func(paramCols, x, self.constants)
+        return np.broadcast_to(f, (len(idx), self.x.shape[-1]))
+
+    # Compute the weighted residuals w_i*(func(p,x_i)-y_i) of the curves indexed by idx
+    def _compute_residuals(self, params, idx):
+        return (self._evalFunc(params, idx) - self.y[idx]) * self.weights[idx]
+
+    # Compute the objective of each curve from its weighted residuals r, i.e. RSS, or
+    # lossScale^2 * sum_i[ rho((r_i/lossScale)^2) ] with a robust loss
+    def _compute_cost(self, r):
+        if self.loss == 'linear':
+            return np.sum(r**2, axis=1)
+        else:
+            return self.lossScale**2 * np.sum(_robustLoss((r/self.lossScale)**2, self.loss)[0], axis=1)
+
+    # Compute the Jacobian of func for the curves indexed by idx
+    # Use user-supplied Jacobian if provided, otherwise compute numerically by
+    # perturbing each parameter once for all curves and datapoints at the same time
+    # Returns a 3D-ndarray of shape (len(idx), M, nParams)
+    def _compute_jacobianFunc(self, params, idx):
+        if self.funcPrime:
+            x = self.x if self.x.ndim == 1 else self.x[idx]
+            paramCols = params.T[:, :, np.newaxis]
+            if self.constants is None:
+                J = self.funcPrime(paramCols, x)
+            else:
+                J = self.funcPrime(paramCols, x, self.constants)
+            return np.broadcast_to(J, (len(idx), self.x.shape[-1], self.nParams))
+        else:
+            return _finiteDiffJacobian(lambda p: self._evalFunc(p, idx), params, self.epsilon, self.finiteDiff)
+
+    # Compute by how much the model values f of the curves indexed by idx leave the range
+    # of their data widened by the span of the data on each side, i.e. the largest distance
+    # of a valid datapoint's model value to [min(y)-span, max(y)+span]
+    def _compute_rangeExcess(self, f, idx):
+        mask = self.mask[idx]
+        yMin = np.min(np.where(mask, self.y[idx], np.inf), axis=1, keepdims=True)
+        yMax = np.max(np.where(mask, self.y[idx], -np.inf), axis=1, keepdims=True)
+        span = yMax - yMin
+        excess = np.maximum(f - (yMax + span), (yMin - span) - f)
+        return np.max(np.where(mask & np.isfinite(excess), np.maximum(excess, 0), 0), axis=1)
+
+    # Main method to fit all curves with a vectorized projected Levenberg-Marquardt algorithm
+    # At each iteration, the damped normal equations
+    #     (J^T J + lambda*diag(J^T J)) delta = -J^T r
+    # are solved as a stack for all curves that have not converged yet. Parameters sitting
+    # at a bound with the descent direction pointing outwards are held fixed for the step
+    # Steps are capped to a trust radius of at most max(|p|, 1), halved at each rejected
+    # step, so that unbounded parameters cannot jump onto a flat region of the model in
+    # one step. Steps are rejected if they do not decrease the objective or if they take
+    # the model values further out of the range of the data (see _compute_rangeExcess)
+    # Curves stopping with a parameter that has no effect on the model (a zero column of J,
+    # e.g. after walking onto a plateau) are reported as stalled rather than converged
+    # With a robust loss, J and r are reweighted by sqrt(rho'(z_i)) at each update of the
+    # normal equations (iteratively reweighted least squares) and steps are accepted if
+    # they decrease the robust objective
+    def _fit(self):
+        N = self.nCurves
+        P = self.nParams
+        lb = np.column_stack([np.broadcast_to(-np.inf if b[0] is None else b[0], (N,)) for b in self.bounds]).astype(float)
+        ub = np.column_stack([np.broadcast_to(np.inf if b[1] is None else b[1], (N,)) for b in self.bounds]).astype(float)
+
+        params = np.clip(np.array(np.broadcast_to(self.params0, (N, P)), dtype=float), lb, ub)
+        allIdx = np.arange(N)
+        with np.errstate(all='ignore'):
+            f = self._evalFunc(params, allIdx)
+            r = (f - self.y) * self.weights
+            excess = self._compute_rangeExcess(f, allIdx)
+        cost = self._compute_cost(r)
+
+        # Scale of the weighted data of each curve, against which the effect of each
+        # parameter on the model is compared to detect plateaus
+        yMean = np.sum(self.y, axis=1, keepdims=True, dtype=float) / np.maximum(self.nDataPoints, 1)[:, np.newaxis]
+        dataScale = np.sqrt(np.sum(((self.y - yMean) * self.weights)**2, axis=1) + np.sum((self.y * self.weights)**2, axis=1))
+        radius = np.maximum(np.sqrt(np.sum(params**2, axis=1)), 1.)
+
+        lam = np.ones(N) * 1e-3
+        nit = np.zeros(N, dtype=int)
+        nfev = np.ones(N, dtype=int)
+        njev = np.zeros(N, dtype=int)
+        status = np.zeros(N, dtype=int)
+        status[~np.isfinite(cost) | (self.nDataPoints < P)] = -1
+        active = status == 0
+
+        # Cache of J^T J and J^T r, recomputed only for curves whose params changed
+        JTJ = np.zeros((N, P, P))
+        JTr = np.zeros((N, P))
+        stale = np.ones(N, dtype=bool)
+        eye = np.eye(P, dtype=bool)
+
+        for _ in range(self.maxiter):
+            idx = np.flatnonzero(active)
+            if len(idx) == 0:
+                break
+
+            with np.errstate(all='ignore'):
+                # Update normal equations of curves that moved at the last iteration
+                idxStale = idx[stale[idx]]
+                if len(idxStale) > 0:
+                    J = self._compute_jacobianFunc(params[idxStale], idxStale) * self.weights[idxStale][:, :, np.newaxis]
+                    rStale = r[idxStale]
+                    if self.loss != 'linear':
+                        robustWeights = np.sqrt(_robustLoss((rStale/self.lossScale)**2, self.loss)[1])
+                        J = J * robustWeights[:, :, np.newaxis]
+                        rStale = rStale * robustWeights
+                    JTJ[idxStale] = np.einsum('nmi,nmj->nij', J, J)
+                    JTr[idxStale] = np.einsum('nmi,nm->ni', J, rStale)
+                    stale[idxStale] = False
+                    njev[idxStale] += 1
+
+                # Hold fixed the parameters blocked by a bound
+                p = params[idx]
+                g = JTr[idx]
+                blocked = ((p <= lb[idx]) & (g > 0)) | ((p >= ub[idx]) & (g < 0))
+                A = JTJ[idx].copy()
+                A[blocked[:, :, np.newaxis] | blocked[:, np.newaxis, :]] = 0
+                g = np.where(blocked, 0, g)
+                diagA = np.maximum(np.diagonal(A, axis1=1, axis2=2), 1e-12)
+                A[:, eye] += lam[idx, np.newaxis] * diagA + blocked
+
+                # Solve for the steps of all active curves at once, capped to the trust radius
+                try:
+                    delta = np.linalg.solve(A, -g[:, :, np.newaxis])[:, :, 0]
+                except np.linalg.LinAlgError:
+                    delta = np.einsum('nij,nj->ni', np.linalg.pinv(A), -g)
+                stepNorm = np.sqrt(np.sum(delta**2, axis=1))
+                delta = delta * np.minimum(1, radius[idx] / stepNorm)[:, np.newaxis]
+
+                newParams = np.clip(p + delta, lb[idx], ub[idx])
+                newF = self._evalFunc(newParams, idx)
+                newR = (newF - self.y[idx]) * self.weights[idx]
+                newExcess = self._compute_rangeExcess(newF, idx)
+                newCost = self._compute_cost(newR)
+                nfev[idx] += 1
+
+            # Accept steps that decrease the objective without leaving the range of the
+            # data, adjust damping and trust radius accordingly
+            improved = (newCost <= cost[idx]) & ((newExcess <= 0) | (newExcess <= excess[idx]))
+            accIdx = idx[improved]
+            rejIdx = idx[~improved]
+            decrease = cost[accIdx] - newCost[improved]
+            stepSize = np.abs(newParams[improved] - p[improved])
+            smallStep = np.all(stepSize <= self.tol * (np.abs(p[improved]) + self.tol), axis=1)
+            params[accIdx] = newParams[improved]
+            r[accIdx] = newR[improved]
+            cost[accIdx] = newCost[improved]
+            excess[accIdx] = newExcess[improved]
+            stale[accIdx] = True
+            lam[accIdx] = np.maximum(lam[accIdx] / 10, 1e-12)
+            lam[rejIdx] *= 10
+            radius[accIdx] = np.minimum(2 * radius[accIdx], np.maximum(np.sqrt(np.sum(params[accIdx]**2, axis=1)), 1.))
+            radius[rejIdx] = np.minimum(radius[rejIdx], stepNorm[~improved]) / 2
+            nit[idx] += 1
+
+            # Check for convergence
+            converged = accIdx[(decrease <= self.tol * cost[accIdx]) | smallStep]
+            status[converged] = 1
+            stuck = idx[lam[idx] > 1e12]
+            status[stuck[status[stuck] == 0]] = 2
+
+            # Curves that stopped with a parameter without effect on the model (from the
+            # last J^T J, computed next to the final params) have stalled on a plateau
+            stopped = idx[status[idx] > 0]
+            effect = np.sqrt(np.diagonal(JTJ[stopped], axis1=1, axis2=2)) * np.maximum(np.abs(params[stopped]), 1.)
+            onPlateau = np.any(effect <= np.sqrt(np.finfo(float).eps) * dataScale[stopped, np.newaxis], axis=1)
+            status[stopped[onPlateau]] = 4
+            active[idx] = status[idx] == 0
+
+        status[active] = 3
+
+        self.params = params
+        self.residuals = r.astype(self.y.dtype, copy=False)
+        self.RSS = np.sum(r**2, axis=1)
+        self.nit = nit
+        self.nfev = nfev
+        self.njev = njev
+        self.status = status
+        self.success = (status == 1) | (status == 2)
+
+    # Compute the Jacobian of func at params that minimizes RSS, zeroed at missing data
+    def _compute_fittedJacobianFunc(self):
+        return self._compute_jacobianFunc(self.params, np.arange(self.nCurves)) * self.mask[:, :, np.newaxis]
+
+    # Compute R-squared from RSS and the weighted residuals r_i kept from the fit, as
+    #     SStot = sum_i[ ((func(p,x_i)-mean(y))*w_i)^2 ] = sum_i[ (r_i+(y_i-mean(y))*w_i)^2 ]
+    # without evaluating func again
+    def _compute_Rsquared(self):
+        yMean = np.sum(self.y, axis=1, keepdims=True, dtype=float) / self.nDataPoints[:, np.newaxis]
+        with np.errstate(all='ignore'):
+            SStot = np.sum((self.residuals + (self.y - yMean) * self.weights)**2, axis=1)
+            return 1 - self.RSS/SStot
+
+    # Compute adjusted R-squared
+    def _compute_adjustedRsquared(self):
+        with np.errstate(all='ignore'):
+            return 1 - (1-self.R2)*(self.nDataPoints-1)/self.DOF.astype(float)
+
+    # Compute reduced Chi-squared/residual variance/mean square error
+    def _compute_reducedChiSquared(self):
+        with np.errstate(all='ignore'):
+            return self.RSS/self.DOF.astype(float)
+
+    # Compute the standard error of the regression/standard error of the equation
+    def _compute_standardErrorRegression(self):
+        return np.sqrt(self.reChi2)
+
+    # Compute the standard error of the fitted parameters from covar = (J^T J)^{-1}
+    # (see lsqcurvefit._compute_paramSEs). Curves with singular J^T J get nan
+    def _compute_paramSEs(self):
+        JTJ = np.einsum('nmi,nmj->nij', self.jacobianFunc, self.jacobianFunc)
+        try:
+            covar = np.linalg.inv(JTJ)
+        except np.linalg.LinAlgError:
+            covar = np.ones_like(JTJ) * np.nan
+            for i in range(self.nCurves):
+                try:
+                    covar[i] = np.linalg.inv(JTJ[i])
+                except np.linalg.LinAlgError:
+                    pass
+        variances = np.diagonal(covar, axis1=1, axis2=2)
+        if self.sigma is None:
+            variances = variances * self.reChi2[:, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(variances)
+
+    # Compute the parameter estimates' t-statistic
+    def _compute_tStatistic(self):
+        with np.errstate(all='ignore'):
+            return self.params/self.paramSEs
+
+    # Compute the p-values given the parameter estimates' t-statistic
+    def _compute_pValuesFromT(self):
+        return stats.t.sf(np.abs(self.paramTvals), self.DOF[:, np.newaxis])*2
+
+    # Public method to compute bootstrap confidence intervals of the fitted parameters
+    def bootstrapCI(self, numSamples=1000, alpha=0.05, maxBatchSize=100000):
+        """Return bootstrap estimates of the 100*(1-alpha)% CIs of the fitted parameters
+        as (lower bounds, upper bounds) arrays of shape (N, P), also assigned to paramLBs
+        and paramUBs. A single index matrix of resampled datapoints (as in liblib.bootstrap)
+        is applied to all curves, and the resamples are fitted with batchcurvefit starting
+        from params, in batches of at most maxBatchSize curves
+        """
+        nCols = self.x.shape[-1]
+        idx = np.random.randint(0, nCols, (numSamples, nCols))
+        self.paramLBs = np.ones((self.nCurves, self.nParams)) * np.nan
+        self.paramUBs = np.ones((self.nCurves, self.nParams)) * np.nan
+
+        # Weights are passed back as sigma = 1/weight, so that masked datapoints
+        # get an infinite sigma, i.e. a zero weight
+        with np.errstate(divide='ignore'):
+            sigma = 1/self.weights
+
+        blockSize = max(1, maxBatchSize // numSamples)
+        for start in range(0, self.nCurves, blockSize):
+            rows = np.arange(start, min(start + blockSize, self.nCurves))
+            if self.x.ndim == 1:
+                x = np.tile(self.x[idx], (len(rows), 1))
+            else:
+                x = self.x[rows][:, idx].reshape(-1, nCols)
+            bounds = [tuple(b if np.ndim(b) == 0 else np.repeat(np.asarray(b)[rows], numSamples) for b in bound)
+                      for bound in self.bounds]
+            bootFitObj = batchcurvefit(self.func, x, self.y[rows][:, idx].reshape(-1, nCols),
+                                       np.repeat(self.params[rows], numSamples, axis=0),
+                                       jac=self.funcPrime, constants=self.constants, bounds=bounds,
+                                       sigma=sigma[rows][:, idx].reshape(-1, nCols),
+                                       maxiter=self.maxiter, tol=self.tol, epsilon=self.epsilon,
+                                       finiteDiff=self.finiteDiff, loss=self.loss, lossScale=self.lossScale)
+            bootParams = np.where(bootFitObj.success[:, np.newaxis], bootFitObj.params, np.nan)
+            bootParams = bootParams.reshape(len(rows), numSamples, self.nParams)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                self.paramLBs[rows], self.paramUBs[rows] = np.nanpercentile(bootParams, [100*alpha/2, 100*(1-alpha/2)], axis=1)
+        return self.paramLBs, self.paramUBs
+
+    # Compute the lower/upper bounds of the bootstrap CIs with the default settings
+    def _compute_paramLBs(self):
+        return self.bootstrapCI()[0]
+
+    def _compute_paramUBs(self):
+        return self.bootstrapCI()[1]
+
+    # Flag the fitted parameters lying on one of their bounds
+    def _compute_atBound(self):
+        return _paramsAtBound(self.params, self.bounds)
+
+    # Describe the termination reason of each curve from its status
+    def _compute_message(self):
+        messages = {1: 'converged', 2: 'no further improvement possible',
+                    3: 'maxiter reached', 4: 'stalled on a plateau of the model',
+                    -1: 'not fitted'}
+        return np.array([messages.get(status, '') for status in self.status])
+
+    # Lazily computed Jacobian and fitting statistics
+    jacobianFunc = _lazyattr('jacobianFunc', _compute_fittedJacobianFunc)
+    R2 = _lazyattr('R2', _compute_Rsquared)
+    adjR2 = _lazyattr('adjR2', _compute_adjustedRsquared)
+    reChi2 = _lazyattr('reChi2', _compute_reducedChiSquared)
+    SER = _lazyattr('SER', _compute_standardErrorRegression)
+    paramSEs = _lazyattr('paramSEs', _compute_paramSEs)
+    paramTvals = _lazyattr('paramTvals', _compute_tStatistic)
+    paramPvals = _lazyattr('paramPvals', _compute_pValuesFromT)
+    paramLBs = _lazyattr('paramLBs', _compute_paramLBs)
+    paramUBs = _lazyattr('paramUBs', _compute_paramUBs)
+    logL = _lazyattr('logL', lambda self: logLikelihood(self.RSS, self.nDataPoints))
+    AIC = _lazyattr('AIC', lambda self: AIC(self.RSS, self.nDataPoints, self.nParams))
+    BIC = _lazyattr('BIC', lambda self: BIC(self.RSS, self.nDataPoints, self.nParams))
+    atBound = _lazyattr('atBound', _compute_atBound)
+    message = _lazyattr('message', _compute_message)
+
+
+class globalcurvefit(batchcurvefit):
+    """Python class for global non-linear least square fitting of many curves at once, with
+       some parameters shared by all the curves of a group (e.g. all the clusters of a variant,
+       or all the clusters of a tile) and the others fitted for each curve
+
+       The shared and per-curve parameters of all curves are fitted together with the
+       trust region reflective algorithm of scipy.optimize.least_squares. The Jacobian of the
+       residuals of such a problem is very sparse: each residual only depends on the per-curve
+       parameters of its curve and on the shared parameters of its group. It is assembled
+       as a scipy.sparse matrix from the (N, M, P) Jacobian of the model evaluated on the whole
+       batch, and the trust region subproblems are solved iteratively with LSMR.
+
+       Takes the same arguments as batchcurvefit, plus:
+
+       Required arguments:
+       - sharedParams: sequence of int
+           Indices of the parameters shared by all curves of a group
+
+       Optional arguments:
+       - groups: N-length sequence
+           Group label of each curve (e.g. variant_number). Shared parameters are shared by
+           all curves if None
+           (default=None)
+
+       Bounds of the shared parameters are taken as the tightest bounds among the curves of
+       each group, and their initial guesses as the medians of params0 among the curves of
+       each group. maxiter is used as the maximum number of function evaluations.
+
+       Attributes after fitting, in addition to the ones of batchcurvefit:
+       - params: (N, P) array, with the shared parameters repeated for each curve of a group
+       - groupLabels: G-length array of the group labels
+       - groupParams: (G, len(sharedParams)) array of the fitted shared parameters
+       - globalRSS, globalDOF: RSS and degrees of freedom of the global fit
+       - globalStatus, globalMessage: status and convergence message of optimize.least_squares
+       - status, message: per-curve status as in batchcurvefit, from the status of the global
+         fit: 1 = converged, 3 = maxiter reached, -1 = not fitted (curves with fewer valid
+         datapoints than per-curve parameters, or improper input)
+       The per-curve statistics (paramSEs, R2, etc.) are computed as in batchcurvefit, i.e.
+       as if each curve had been fitted on its own with all its parameters
+    """
+
+    def __init__(self, func, x, y, params0, sharedParams, groups=None, **kwargs):
+        self.sharedParams = list(sharedParams)
+        self.groups = groups
+        batchcurvefit.__init__(self, func, x, y, params0, **kwargs)
+
+    # Main method to fit all curves globally with optimize.least_squares
+    def _fit(self):
+        N = self.nCurves
+        M = self.x.shape[-1]
+        P = self.nParams
+        shared = np.array(self.sharedParams, dtype=int)
+        local = np.array([j for j in range(P) if j not in self.sharedParams], dtype=int)
+        Pg = len(shared)
+        Pl = len(local)
+        allIdx = np.arange(N)
+
+        # Group curves
+        if self.groups is None:
+            codes = np.zeros(N, dtype=int)
+            self.groupLabels = np.array([None])
+        else:
+            codes, self.groupLabels = pd.factorize(pd.Series(self.groups))
+            if np.any(codes < 0):
+                raise ValueError("All curves need to belong to a group!")
+            self.groupLabels = np.asarray(self.groupLabels)
+        G = len(self.groupLabels)
+
+        # Bounds and initial guesses of the shared and per-curve parameters
+        lb = np.column_stack([np.broadcast_to(-np.inf if b[0] is None else b[0], (N,)) for b in self.bounds]).astype(float)
+        ub = np.column_stack([np.broadcast_to(np.inf if b[1] is None else b[1], (N,)) for b in self.bounds]).astype(float)
+        params0 = np.clip(np.array(np.broadcast_to(self.params0, (N, P)), dtype=float), lb, ub)
+
+        groupLB = pd.DataFrame(lb[:, shared]).groupby(codes).max().sort_index().values
+        groupUB = pd.DataFrame(ub[:, shared]).groupby(codes).min().sort_index().values
+        groupParams0 = pd.DataFrame(params0[:, shared]).groupby(codes).median().sort_index().values
+        groupParams0 = np.clip(groupParams0, groupLB, groupUB)
+
+        theta0 = np.concatenate([groupParams0.ravel(), params0[:, local].ravel()])
+        thetaLB = np.concatenate([groupLB.ravel(), lb[:, local].ravel()])
+        thetaUB = np.concatenate([groupUB.ravel(), ub[:, local].ravel()])
+
+        # Map the vector of fitted variables to the (N, P) array of parameters of all curves
+        def unpack(theta):
+            params = np.empty((N, P))
+            params[:, shared] = theta[:G*Pg].reshape(G, Pg)[codes]
+            params[:, local] = theta[G*Pg:].reshape(N, Pl)
+            return params
+
+        def residuals(theta):
+            return self._compute_residuals(unpack(theta), allIdx).ravel()
+
+        # Sparsity structure of the Jacobian: residual (i, m) depends on the shared
+        # parameters of group codes[i] and on the per-curve parameters of curve i
+        rows = np.repeat(np.arange(N*M), P)
+        cols = np.empty((N, M, P), dtype=int)
+        cols[:, :, shared] = (codes[:, np.newaxis] * Pg + np.arange(Pg))[:, np.newaxis, :]
+        cols[:, :, local] = (G*Pg + allIdx[:, np.newaxis] * Pl + np.arange(Pl))[:, np.newaxis, :]
+        cols = cols.ravel()
+
+        def jacobian(theta):
+            J = self._compute_jacobianFunc(unpack(theta), allIdx) * self.weights[:, :, np.newaxis]
+            return sparse.csr_matrix((J.ravel(), (rows, cols)), shape=(N*M, G*Pg + N*Pl))
+
+        results = optimize.least_squares(residuals, theta0, jac=jacobian, bounds=(thetaLB, thetaUB),
+                                         method='trf', tr_solver='lsmr', x_scale='jac',
+                                         loss=self.loss, f_scale=self.lossScale, max_nfev=self.maxiter,
+                                         ftol=self.tol, xtol=self.tol, gtol=self.tol)
+
+        self.params = unpack(results.x)
+        self.groupParams = results.x[:G*Pg].reshape(G, Pg)
+        self.residuals = results.fun.reshape(N, M)
+        self.RSS = np.sum(self.residuals**2, axis=1)
+        self.globalRSS = np.sum(self.RSS)
+        self.globalDOF = np.sum(self.nDataPoints) - G*Pg - N*Pl
+        self.nit = np.ones(N, dtype=int) * results.nfev
+        self.nfev = np.ones(N, dtype=int) * results.nfev
+        self.njev = np.ones(N, dtype=int) * results.njev
+        self.globalStatus = results.status
+        self.globalMessage = results.message
+
+        # Map the status of least_squares (1 to 4 = converged on one of the tolerances,
+        # 0 = max_nfev reached, -1 = improper input) to the per-curve status of batchcurvefit
+        if results.status > 0:
+            status = 1
+        elif results.status == 0:
+            status = 3
+        else:
+            status = -1
+        self.status = np.ones(N, dtype=int) * status
+        self.status[self.nDataPoints < Pl] = -1
+        self.success = self.status == 1
+
+
+class fitresults(object):
+    """Compact container of the results of many fits, backed by a numpy structured array
+
+       Results are copied into preallocated records as the fits finish so that the fit
+       objects (and their copies of x, y, sigma, Jacobian, etc.) can be discarded right
+       away. Memory usage is O(nFits x nParams).
+
+
+    Usages:
+
+       fitRes = fitlib.fitresults(nFits, nParams, attrs=None, floatType=float)
+
+       Required arguments:
+       - nFits: number of fits to store
+       - nParams: number of fit parameters
+
+       Optional arguments:
+       - attrs: list of attributes of lsqcurvefit/batchcurvefit to store. Store all the
+                supported attributes if None (default=None)
+       - floatType: type of the floating point attributes. Use np.float32 to halve the
+                    memory footprint of large result tables (default=float)
+
+       To fill with the results of a lsqcurvefit object or a batchcurvefit object:
+
+       fitRes.fill(i, fitObj)
+
+       where i is the index of the fit, or a slice/index array matching the rows of a
+       batchcurvefit object
+
+       Stored attributes are accessible as numpy arrays, e.g. fitRes.params has shape
+       (nFits, nParams) and fitRes.RSS has shape (nFits,)
+
+       The convergence telemetry of the fits (nit, nfev, njev, fitTime, success, message,
+       atBound) can be summarized in a table or plotted as histograms:
+
+       summary = fitRes.telemetrySummary(paramNames=None)
+       fig = fitRes.plotTelemetry(figsize=None, bins=50, paramNames=None)
+    """
+
+    # Supported attributes and their dtypes
+    paramAttrs = ['params', 'paramSEs', 'paramTvals', 'paramPvals', 'paramLBs', 'paramUBs']
+    scalarAttrs = [('RSS', float), ('R2', float), ('adjR2', float), ('reChi2', float), ('SER', float),
+                   ('logL', float), ('AIC', float), ('BIC', float),
+                   ('DOF', int), ('nDataPoints', int), ('nit', int), ('status', int), ('success', bool),
+                   ('nfev', int), ('njev', int), ('fitTime', float), ('message', 'S64')]
+    flagAttrs = ['atBound']
+
+    def __init__(self, nFits, nParams, attrs=None, floatType=float):
+        self.nFits = nFits
+        self.nParams = nParams
+        self.floatType = floatType
+        dtype = ([(attr, floatType, (nParams,)) for attr in self.paramAttrs] +
+                 [(attr, bool, (nParams,)) for attr in self.flagAttrs] +
+                 [(attr, floatType if attrType is float else attrType) for attr, attrType in self.scalarAttrs])
+        if attrs is not None:
+            dtype = [field for field in dtype if field[0] in attrs]
+            unsupported = set(attrs) - set(field[0] for field in dtype)
+            if unsupported:
+                raise ValueError("Attributes not supported by fitresults: "+", ".join(sorted(unsupported)))
+        self.records = np.zeros(nFits, dtype=dtype)
+        for name in self.records.dtype.names:
+            if self.records.dtype[name].base.kind == 'f':
+                self.records[name] = np.nan
+            elif self.records.dtype[name].kind == 'i':
+                self.records[name] = -1
+
+    def __len__(self):
+        return self.nFits
+
+    # Give access to the stored attributes as arrays
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'records':
+            raise AttributeError(name)
+        try:
+            return self.records[name]
+        except ValueError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self.records[name]
+
+    # Copy the results of a lsqcurvefit object or batchcurvefit object into the
+    # record(s) indexed by i
+    def fill(self, i, fitObj):
+        for name in self.records.dtype.names:
+            value = getattr(fitObj, name)
+            if value is not None:
+                self.records[name][i] = value
+
+    # Convert stored attributes to a Pandas dataframe, with parameter-like
+    # attributes expanded into columns attr1, attr2, ...
+    def toDataFrame(self, attrs=None, index=None):
+        if attrs is None:
+            attrs = self.records.dtype.names
+        columns = []
+        for attr in attrs:
+            val = self.records[attr]
+            if val.ndim == 1:
+                columns.append(pd.DataFrame({attr: val}, index=index))
+            else:
+                columns.append(pd.DataFrame(val, columns=[attr+str(i+1) for i in range(val.shape[1])], index=index))
+        return pd.concat(columns, axis=1)
+
+    # Summarize the convergence telemetry of the stored fits in a table with the mean,
+    # median, 95th percentile, max and total of each counter over all fits (counters not
+    # recorded for any fit, e.g. fitTime of batch fits, are left out), the fraction
+    # and number of successful fits, of fits with each parameter ending on a bound, and
+    # of failed fits for each failure reason
+    def telemetrySummary(self, paramNames=None):
+        """Return a dataframe summarizing the convergence telemetry of the stored fits"""
+        names = self.records.dtype.names
+        columns = ['mean', 'median', '95%', 'max', 'total']
+        rows = []
+        index = []
+        for attr in ['nit', 'nfev', 'njev', 'fitTime']:
+            if attr in names:
+                val = self.records[attr].astype(float)
+                val = val[np.where(np.isfinite(val), val, -1) >= 0]
+                if len(val) == 0:
+                    continue
+                rows.append([np.mean(val), np.median(val), np.percentile(val, 95), np.max(val), np.sum(val)])
+                index.append(attr)
+        if 'success' in names:
+            rows.append([np.mean(self.records['success']), np.nan, np.nan, np.nan, np.sum(self.records['success'])])
+            index.append('success')
+        if 'atBound' in names:
+            if paramNames is None:
+                paramNames = [str(j+1) for j in range(self.nParams)]
+            for j, paramName in enumerate(paramNames):
+                atBound = self.records['atBound'][:, j]
+                rows.append([np.mean(atBound), np.nan, np.nan, np.nan, np.sum(atBound)])
+                index.append('atBound '+paramName)
+        if 'message' in names:
+            isFailed = ~self.records['success'] if 'success' in names else np.ones(self.nFits, dtype=bool)
+            failures = pd.Series(self.records['message'][isFailed]).value_counts()
+            for message, count in failures.iteritems():
+                rows.append([float(count)/self.nFits, np.nan, np.nan, np.nan, count])
+                index.append('failed: '+message)
+        return pd.DataFrame(rows, index=index, columns=columns)
+
+    # Plot the histograms of the convergence telemetry of the stored fits, and the fraction
+    # of fits with each parameter ending on a bound
+    def plotTelemetry(self, figsize=None, bins=50, paramNames=None):
+        """Plot the histograms of the convergence telemetry of the stored fits"""
+        names = self.records.dtype.names
+        attrs = [attr for attr in ['nit', 'nfev', 'njev', 'fitTime']
+                 if attr in names and np.any(np.where(np.isfinite(self.records[attr]), self.records[attr], -1) >= 0)]
+        nPlots = len(attrs) + ('atBound' in names)
+        if figsize is None:
+            figsize = (4 * max(nPlots, 1), 4)
+
+        fig, axes = plt.subplots(1, max(nPlots, 1), figsize=figsize, squeeze=False)
+        fig.patch.set_facecolor('w')
+        for ax, attr in zip(axes[0], attrs):
+            val = self.records[attr].astype(float)
+            ax.hist(val[np.where(np.isfinite(val), val, -1) >= 0], bins=bins)
+            ax.set_xlabel(attr)
+            ax.set_ylabel('Number of fits')
+        if 'atBound' in names:
+            ax = axes[0][len(attrs)]
+            if paramNames is None:
+                paramNames = [str(j+1) for j in range(self.nParams)]
+            ax.bar(np.arange(self.nParams), np.mean(self.records['atBound'], axis=0))
+            ax.set_xticks(np.arange(self.nParams))
+            ax.set_xticklabels(paramNames)
+            ax.set_xlabel('Parameter')
+            ax.set_ylabel('Fraction of fits at a bound')
+        fig.tight_layout()
+
+        return fig
+
+    # Static method to concatenate a list of fitresults objects
+    @staticmethod
+    def concat(listFitResults):
+        fitRes = fitresults(0, listFitResults[0].nParams, attrs=listFitResults[0].records.dtype.names,
+                            floatType=listFitResults[0].floatType)
+        fitRes.records = np.concatenate([r.records for r in listFitResults])
+        fitRes.nFits = len(fitRes.records)
+        return fitRes
+
+
+# Compute data-driven initial guesses of the parameters of many curves at once with the
+# initializer registered for func in fitfuns (or init if given). Parameters that cannot
+# be estimated from a curve (no initializer, or non-finite estimates) fall back to params0,
+# and all guesses are clipped to bounds
+def dataDrivenParams0(func, x, y, params0, bounds=None, constants=None, init=None):
+    """Return data-driven initial guesses of the parameters of the curves in the rows of y
+
+       Required arguments:
+       - func, params0: as in batchcurvefit
+       - x: M-length sequence or (N, M) array
+       - y: (N, M) array, one curve per row (nan for missing data)
+
+       Optional arguments:
+       - bounds, constants: as in batchcurvefit
+       - init: initializer to use instead of the one registered for func in fitfuns,
+               called as init(x, y) or init(x, y, constants)
+
+       Returns:
+       - (N, P) array of initial guesses
+    """
+    y = np.array(y, dtype=float, ndmin=2)
+    nParams = len(params0)
+    curveParams0 = np.tile(np.array(params0, dtype=float), (len(y), 1))
+    if init is None:
+        init = fitfuns.getInit(func)
+    if init is not None:
+        with np.errstate(all='ignore'):
+            guess = init(x, y) if constants is None else init(x, y, constants)
+        curveParams0 = np.where(np.isfinite(guess), guess, curveParams0)
+    if bounds:
+        lowerBounds = [-np.inf if b[0] is None else b[0] for b in bounds]
+        upperBounds = [np.inf if b[1] is None else b[1] for b in bounds]
+        curveParams0 = np.clip(curveParams0, np.array(lowerBounds, dtype=float),
+                               np.array(upperBounds, dtype=float))
+    return curveParams0.reshape(-1, nParams)
+
+
+# Fit the median curve of each group of curves (e.g. the clusters of a variant) with
+# batchcurvefit and return the group fits as the initial guesses, and optionally the
+# bounds, of the single-curve fits of their members. Curves with no group (nan) or
+# whose group fit failed keep the global params0 (or their own data-driven initial
+# guesses if dataInit) and bounds.
+# Only bounds are honored in the group fits
+def groupWarmStart(func, x, y, groups, params0, bounds=None, constants=None,
+                   boundsSE=None, dataInit=False, **kwargs):
+    """Fit group medians and return per-curve params0 and bounds for warm-starting single-curve fits
+
+       Required arguments:
+       - func, params0: as in batchcurvefit
+       - x: M-length sequence or (N, M) array. Per-curve x are summarized by their group medians
+       - y: (N, M) array, one curve per row
+       - groups: N-length sequence of group labels (e.g. variant_number), nan for no group
+
+       Optional arguments:
+       - bounds, constants: as in batchcurvefit
+       - boundsSE: if provided, bound the parameters of each curve to within boundsSE standard
+                   errors of its group's fitted parameters (intersected with bounds)
+       - dataInit: if True, start the group fits from the data-driven initial guesses of
+                   dataDrivenParams0 instead of params0
+       - kwargs: passed to batchcurvefit for the group fits
+
+       Returns:
+       - curveParams0: (N, P) array of initial guesses
+       - curveBounds: list of P tuples of N-length lower and upper bounds, as accepted by
+                      batchcurvefit (and by lsqcurvefit row by row)
+       - groupFitObj: the batchcurvefit object of the group median fits, or None if no curve
+                      belongs to a group, in which case params0 (or the data-driven initial
+                      guesses) and bounds are returned for all curves
+    """
+    y = np.array(y, dtype=float)
+    x = np.array(x, dtype=float)
+    nCurves = len(y)
+    nParams = len(params0)
+    if not bounds:
+        bounds = [(None, None)] * nParams
+
+    # Initial guesses and bounds of the curves without a group
+    if dataInit:
+        curveParams0 = dataDrivenParams0(func, x, y, params0, bounds=bounds, constants=constants)
+    else:
+        curveParams0 = np.tile(np.array(params0, dtype=float), (nCurves, 1))
+    lowerBounds = np.tile([-np.inf if b[0] is None else b[0] for b in bounds], (nCurves, 1)).astype(float)
+    upperBounds = np.tile([np.inf if b[1] is None else b[1] for b in bounds], (nCurves, 1)).astype(float)
+
+    codes, _ = pd.factorize(pd.Series(groups))
+    inGroup = codes >= 0
+    if not inGroup.any():
+        return curveParams0, list(zip(lowerBounds.T, upperBounds.T)), None
+
+    # Compute group medians
+    groupY = pd.DataFrame(y[inGroup]).groupby(codes[inGroup]).median().sort_index()
+    if x.ndim == 2:
+        groupX = pd.DataFrame(x[inGroup]).groupby(codes[inGroup]).median().sort_index().values
+    else:
+        groupX = x
+
+    # Fit group medians
+    if dataInit:
+        groupParams0 = dataDrivenParams0(func, groupX, groupY.values, params0,
+                                         bounds=bounds, constants=constants)
+    else:
+        groupParams0 = params0
+    groupFitObj = batchcurvefit(func, groupX, groupY.values, groupParams0,
+                                bounds=bounds, constants=constants, **kwargs)
+    groupOK = groupFitObj.success & np.all(np.isfinite(groupFitObj.params), axis=1)
+
+    # Map group fits onto curves
+    curveCodes = np.where(inGroup, codes, 0)
+    useGroup = inGroup & groupOK[curveCodes]
+    curveParams0[useGroup] = groupFitObj.params[curveCodes[useGroup]]
+
+    if boundsSE is not None:
+        groupSEs = groupFitObj.paramSEs[curveCodes]
+        withSE = useGroup[:, np.newaxis] & np.isfinite(groupSEs)
+        lowerBounds = np.where(withSE, np.maximum(lowerBounds, curveParams0 - boundsSE * groupSEs), lowerBounds)
+        upperBounds = np.where(withSE, np.minimum(upperBounds, curveParams0 + boundsSE * groupSEs), upperBounds)
+    curveBounds = list(zip(lowerBounds.T, upperBounds.T))
+
+    return curveParams0, curveBounds, groupFitObj
+
+
+class fitcache(object):
+    """Content-addressed on-disk cache of fit results
+
+       Each fit is keyed on a hash of everything that determines its result: the model
+       function (its code, not just its name), the fitting parameters shared by all fits
+       (params0, bounds, constants, method, tol, ...) and the data of the fit itself (y, and
+       x, sigma, params0 or bounds when they differ from fit to fit). Re-running a fit on
+       unchanged data is then served from disk, and only new or changed fits are computed.
+       Results are stored as fitresults records, along with their keys, in .npy files under
+       cacheDir. The index of the cache, mapping each key to the file and row of its record,
+       is built once per cache object on the first lookup and updated by store, and lookups
+       only read the rows they need from the files, so that records are not held in memory.
+       On store, the cache files with no more records than the new one are merged into it,
+       so that the number of cache files only grows logarithmically with the number of
+       stores. Fits stored by other processes in the meantime are only seen by new cache
+       objects, or once the index is rebuilt because one of its files was merged by another
+       process.
+
+
+    Usages:
+
+       cache = fitlib.fitcache(cacheDir, func, attrs=None, floatType=float, **fitParams)
+
+       Required arguments:
+       - cacheDir: directory to store the cache files in. Created if it does not exist
+       - func: model function
+
+       Optional arguments:
+       - attrs: list of attributes stored, as in fitresults
+       - floatType: type of the floating point attributes stored, as in fitresults
+       - fitParams: any other fitting parameters shared by all fits (e.g. params0, bounds,
+                    method, tol, x if shared)
+
+       To get the keys of N fits, given the per-fit data as arrays with N rows:
+
+       keys = cache.rowKeys(y, [x, sigma, params0, ...])
+
+       To look up fit results and store new ones:
+
+       isCached, fitRes = cache.lookup(keys)
+       cache.store(keys[~isCached], fitRes.records[~isCached])
+    """
+
+    def __init__(self, cacheDir, func, attrs=None, floatType=float, **fitParams):
+        self.cacheDir = cacheDir
+        self.attrs = attrs
+        self.floatType = floatType
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+        spec = hashlib.sha1()
+        spec.update(self._toBytes(func))
+        spec.update(self._toBytes(list(attrs) if attrs is not None else None))
+        if np.dtype(floatType) != np.float64:
+            spec.update(np.dtype(floatType).str)
+        for name in sorted(fitParams):
+            spec.update(name)
+            spec.update(self._toBytes(fitParams[name]))
+        self.specDigest = spec.hexdigest()
+        self.nParams = np.shape(fitParams.get('params0', []))[-1]
+        self._index = None
+        self._listFiles = []
+
+    # Convert a fitting parameter into bytes to be hashed. Functions are identified by
+    # their module, name and code so that editing a model function invalidates the cache
+    @classmethod
+    def _toBytes(cls, value):
+        if isinstance(value, np.ndarray):
+            return str(value.dtype) + str(value.shape) + np.ascontiguousarray(value).tobytes()
+        elif callable(value):
+            code = value.__code__
+            consts = [c for c in code.co_consts if not hasattr(c, 'co_code')]
+            return '{}.{}:{}:{}:{}'.format(value.__module__, value.__name__,
+                                           code.co_code, code.co_names, repr(consts))
+        elif isinstance(value, (list, tuple)):
+            return type(value).__name__ + '(' + ','.join(cls._toBytes(v) for v in value) + ')'
+        elif isinstance(value, dict):
+            return '{' + ','.join(k + ':' + cls._toBytes(value[k]) for k in sorted(value)) + '}'
+        else:
+            return repr(value)
+
+    # Compute the keys of N fits from the per-fit data, given as arrays with N rows
+    # Trailing nan of each row are left out, so that the key of a fit does not depend on
+    # the width its data were padded to along with other fits
+    def rowKeys(self, *arrays):
+        nFits = len(arrays[0])
+        listArrays = []
+        listWidths = []
+        for a in arrays:
+            a = np.array(a, dtype=float).reshape(nFits, -1)
+            isValid = ~np.isnan(a)
+            listArrays.append(a)
+            listWidths.append(np.where(isValid.any(axis=1), a.shape[1] - np.argmax(isValid[:, ::-1], axis=1), 0))
+        keys = np.empty(nFits, dtype='S40')
+        for i in range(nFits):
+            digest = hashlib.sha1(self.specDigest)
+            for a, widths in zip(listArrays, listWidths):
+                digest.update(str(widths[i]))
+                digest.update(np.ascontiguousarray(a[i, :widths[i]]).tobytes())
+            keys[i] = digest.hexdigest()
+        return keys
+
+    # List the cache files written with the same fitting parameters
+    def _listCacheFiles(self):
+        prefix = 'fitcache_' + self.specDigest[:16] + '_'
+        return sorted(os.path.join(self.cacheDir, f) for f in os.listdir(self.cacheDir)
+                      if f.startswith(prefix) and f.endswith('.npy'))
+
+    # Get the number of records of a cache file from its name
+    @staticmethod
+    def _fileSize(filePath):
+        return int(os.path.basename(filePath).split('_')[2])
+
+    # Add the keys of a cache file to the in-memory index, mapping each key to the position
+    # of its record as (number of the file, row)
+    def _addToIndex(self, filePath, keys):
+        n = len(self._listFiles)
+        self._listFiles.append(filePath)
+        self._index.update((key, (n, i)) for i, key in enumerate(keys))
+
+    # Build the in-memory index from the keys of the cache files written with the same
+    # fitting parameters
+    def _loadIndex(self):
+        self._index = {}
+        self._listFiles = []
+        for filePath in self._listCacheFiles():
+            try:
+                self._addToIndex(filePath, np.load(filePath, mmap_mode='r')['key'])
+            except IOError:
+                # Merged into another cache file by another process
+                continue
+
+    # Read the records of keys from the cache files given by the index
+    # Return a boolean array indicating which keys were read, a fitresults object with their
+    # records filled in, and whether all the indexed cache files could be read
+    def _readRecords(self, keys):
+        fitRes = fitresults(len(keys), self.nParams, attrs=self.attrs, floatType=self.floatType)
+        positions = np.array([self._index.get(key, (-1, -1)) for key in keys], dtype=int).reshape(-1, 2)
+        isCached = positions[:, 0] >= 0
+        isComplete = True
+        for n in np.unique(positions[isCached, 0]):
+            isInFile = positions[:, 0] == n
+            try:
+                rows = np.load(self._listFiles[n], mmap_mode='r')[positions[isInFile, 1]]
+            except IOError:
+                # Merged into another cache file by another process since the index was built
+                isCached[isInFile] = False
+                isComplete = False
+                continue
+            for name in fitRes.records.dtype.names:
+                fitRes.records[name][isInFile] = rows[name]
+        return isCached, fitRes, isComplete
+
+    # Look up keys in the cache
+    # Return a boolean array indicating which keys are cached, and a fitresults object
+    # with the cached results filled in
+    def lookup(self, keys):
+        if self._index is None:
+            self._loadIndex()
+        isCached, fitRes, isComplete = self._readRecords(keys)
+        if not isComplete:
+            self._loadIndex()
+            isCached, fitRes, _ = self._readRecords(keys)
+        return isCached, fitRes
+
+    # Store the fit results (fitresults records) of the given keys in a new cache file,
+    # merged with the cache files with no more records, and in the in-memory index if
+    # already built
+    def store(self, keys, records):
+        if len(keys) == 0:
+            return
+        data = np.empty(len(keys), dtype=[('key', 'S40')] + records.dtype.descr)
+        data['key'] = keys
+        for name in records.dtype.names:
+            data[name] = records[name]
+
+        listMergedPaths = []
+        for filePath in sorted(self._listCacheFiles(), key=self._fileSize):
+            if self._fileSize(filePath) > len(data):
+                break
+            try:
+                data = np.concatenate([data, np.load(filePath)])
+            except IOError:
+                # Merged into another cache file by another process
+                continue
+            listMergedPaths.append(filePath)
+
+        fileName = 'fitcache_{}_{}_{}.npy'.format(self.specDigest[:16], len(data), uuid.uuid4().hex)
+        filePath = os.path.join(self.cacheDir, fileName)
+        with open(filePath + '.tmp', 'wb') as f:
+            np.save(f, data)
+        os.rename(filePath + '.tmp', filePath)
+        for mergedPath in listMergedPaths:
+            try:
+                os.remove(mergedPath)
+            except OSError:
+                pass
+        if self._index is not None:
+            self._addToIndex(filePath, data['key'])
+
+
+class fitcheckpoint(object):
+    """Checkpoint of a long fitting run, to resume it after an interruption
+
+       The checkpoint records how many fits of the run are done, along with whatever else is
+       needed to resume it (e.g. the size of the output file written so far, or the fitresults
+       records of the fits done), and a digest of the inputs of the run: the sizes and
+       modification times of its input files (so that large inputs are not read just to
+       checkpoint a run) and the fitting parameters and options that determine its results.
+       A run can only be resumed from a checkpoint saved with the same inputs.
+       Checkpoints are saved as .npz files, replacing the previous one atomically.
+
+
+    Usages:
+
+       checkpoint = fitlib.fitcheckpoint(checkpointFilePath, inputFilePaths, **fitParams)
+
+       Required arguments:
+       - checkpointFilePath: path to the checkpoint file, ending in .npz
+       - inputFilePaths: list of paths to the input files of the run
+
+       Optional arguments:
+       - fitParams: any fitting parameters and options of the run, hashed as in fitcache
+
+       To save a checkpoint after each chunk of fits:
+
+       checkpoint.save(nDone, **state)
+
+       To resume a run, skipping the first nDone fits:
+
+       nDone, state = checkpoint.load()
+
+       where nDone = 0 and state = {} if there is no checkpoint yet. Raises ValueError if the
+       checkpoint was saved with different inputs
+
+       To remove the checkpoint once the run is complete:
+
+       checkpoint.remove()
+    """
+
+    def __init__(self, checkpointFilePath, inputFilePaths, **fitParams):
+        self.checkpointFilePath = checkpointFilePath
+
+        digest = hashlib.sha1()
+        for filePath in inputFilePaths:
+            fileStat = os.stat(filePath)
+            digest.update('{}:{!r}'.format(fileStat.st_size, fileStat.st_mtime))
+        for name in sorted(fitParams):
+            digest.update(name)
+            digest.update(fitcache._toBytes(fitParams[name]))
+        self.inputDigest = digest.hexdigest()
+
+    # Save the number of fits done and the state needed to resume the run
+    def save(self, nDone, **state):
+        tmpPath = self.checkpointFilePath[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmpPath, inputDigest=self.inputDigest, nDone=nDone, **state)
+        os.rename(tmpPath, self.checkpointFilePath)
+
+    # Load the number of fits done and the state saved with them
+    def load(self):
+        if not os.path.isfile(self.checkpointFilePath):
+            return 0, {}
+        data = np.load(self.checkpointFilePath)
+        if str(data['inputDigest']) != self.inputDigest:
+            raise ValueError("The inputs of the run have changed since checkpoint {} was saved!".format(self.checkpointFilePath))
+        state = {name: data[name] for name in data.files if name not in ['inputDigest', 'nDone']}
+        return int(data['nDone']), state
+
+    # Remove the checkpoint
+    def remove(self):
+        if os.path.isfile(self.checkpointFilePath):
+            os.remove(self.checkpointFilePath)
+
+
+class fitspec(object):
+    """Declarative and serializable specification of a fit
+
+       A fitspec holds everything needed to fit a curve with lsqcurvefit or batchcurvefit
+       except the data: the model, referred to by its name in the registry of fitfuns
+       (fitfuns.models), params0, bounds, method and the other fitting parameters, as well
+       as x and outputAttrs. It is parsed and validated once, and pickles to its model name
+       and a few small arrays, so that it is cheap to send to parallel workers. The model
+       function and its Jacobian are only looked up from the registry when first needed.
+       Models that are not registered are kept as functions.
+
+
+    Usages:
+
+       spec = fitlib.fitspec(model, params0, x=None, outputAttrs=['params'], **fitParams)
+
+       Required arguments:
+       - model: name of a model in fitfuns.models, or a model function
+       - params0: initial guess of the parameters
+
+       Optional arguments:
+       - x: independent variables, or the name of the column containing them
+       - outputAttrs: list of attributes of the fits to output
+       - fitParams: any other argument of lsqcurvefit (bounds, method, maxiter, ...)
+
+       To parse a fitParamFile:
+
+       spec = fitlib.fitspec.fromFile(fitParamFilePath)
+
+       To fit with a fitspec:
+
+       fitObj = fitlib.lsqcurvefit(x=spec.x, y=y, **spec.fitParamDict)
+    """
+
+    # Default values of the fitting parameters that will be passed to lsqcurvefit
+    # This should be updated when new argument is added to fitlib.lsqcurvefit()
+    defaults = {'jac': None,
+                'constants': None,
+                'bounds': None,
+                'constraints': (),
+                'sigma': None,
+                'method': 'SLSQP',
+                'backend': 'minimize',
+                'maxiter': 200,
+                'tol': None,
+                'epsilon': None,
+                'finiteDiff': 'forward',
+                'loss': 'linear',
+                'lossScale': 1.0,
+                'disp': False}
+
+    # Parsed fitParamFiles, keyed on their absolute paths and modification times
+    _parsedFiles = {}
+
+    def __init__(self, model, params0, x=None, outputAttrs=['params'], **fitParams):
+        unknown = set(fitParams) - set(self.defaults)
+        if unknown:
+            raise ValueError("Unknown fitting parameters: "+", ".join(sorted(unknown)))
+
+        # Refer to registered models and their registered Jacobians by name
+        if callable(model) and fitfuns.models.get(model.__name__, {}).get('func') is model:
+            model = model.__name__
+        if isinstance(model, str) and model not in fitfuns.models:
+            raise ValueError("Model not found in fitfuns.models: "+model)
+        if isinstance(model, str) and fitParams.get('jac') is fitfuns.models[model]['jac']:
+            fitParams.pop('jac')
+
+        self.model = model
+        self.params0 = list(params0)
+        self.x = x
+        self.outputAttrs = list(outputAttrs)
+        self.fitParams = dict(self.defaults, **fitParams)
+
+        self._validate()
+
+    # Check the consistency of the fitting parameters
+    def _validate(self):
+        nParams = len(self.params0)
+        if self.fitParams['bounds'] and len(self.fitParams['bounds']) != nParams:
+            raise ValueError("The number of bounds does not match the number of parameters!")
+        if self.fitParams['backend'] not in ['auto', 'minimize', 'least_squares']:
+            raise ValueError("backend must be either 'auto', 'minimize' or 'least_squares'!")
+        if self.fitParams['finiteDiff'] not in ['forward', 'central']:
+            raise ValueError("finiteDiff must be either 'forward' or 'central'!")
+        fitresults(0, nParams, attrs=self.outputAttrs)
+
+    # Only pickle the declarative part of the spec, not the resolved functions
+    def __getstate__(self):
+        return {key: self.__dict__[key] for key in ['model', 'params0', 'x', 'outputAttrs', 'fitParams']}
+
+    # Look up the model function from the registry
+    def _compute_func(self):
+        if isinstance(self.model, str):
+            return fitfuns.models[self.model]['func']
+        else:
+            return self.model
+
+    # Look up the Jacobian of the model from the registry if not specified
+    def _compute_jac(self):
+        if self.fitParams['jac'] is None and isinstance(self.model, str):
+            return fitfuns.models[self.model]['jac']
+        else:
+            return self.fitParams['jac']
+
+    # Make the dictionary of arguments to be passed to lsqcurvefit
+    def _compute_fitParamDict(self):
+        return dict(self.fitParams, func=self.func, jac=self.jac, params0=self.params0)
+
+    func = _lazyattr('func', _compute_func)
+    jac = _lazyattr('jac', _compute_jac)
+    fitParamDict = _lazyattr('fitParamDict', _compute_fitParamDict)
+
+    @classmethod
+    def fromFile(cls, fitParamFilePath):
+        """Parse and validate a fitParamFile, a Python file defining the arguments of
+           lsqcurvefit (with either func or the name of a registered model as model),
+           x and outputAttrs. Specs are cached until the file is modified"""
+        key = (os.path.abspath(fitParamFilePath), os.path.getmtime(fitParamFilePath))
+        if key not in cls._parsedFiles:
+            # Execute fitParamFile in a fresh module, with its directory at the end of the path
+            # so that it can import helpers next to it without shadowing other modules. The module is named after the path of the file
+            # rather than its basename so that it does not clobber an imported module of the
+            # same name, and is registered in sys.modules so that the functions it defines can
+            # be pickled. It has no __file__ so that parallel workers, which cannot import it,
+            # receive these functions by value
+            fitParamDir = os.path.dirname(os.path.abspath(fitParamFilePath))
+            if fitParamDir not in sys.path:
+                sys.path.append(fitParamDir)
+            moduleName = '_fitParam_' + hashlib.md5(os.path.abspath(fitParamFilePath)).hexdigest()
+            fitParam = ModuleType(moduleName)
+            sys.modules[moduleName] = fitParam
+            with open(fitParamFilePath) as f:
+                exec(compile(f.read(), fitParamFilePath, 'exec'), vars(fitParam))
+            userDefinedFitParamDict = {property_: value
+                                       for property_, value in vars(fitParam).iteritems()
+                                       if property_[:2] != '__' and not isinstance(value, ModuleType)}
+            if 'model' not in userDefinedFitParamDict:
+                userDefinedFitParamDict['model'] = userDefinedFitParamDict.pop('func', None)
+            cls._parsedFiles[key] = cls(**userDefinedFitParamDict)
+        return cls._parsedFiles[key]
+
+
+# Compute the maximized log likelihood of least square fits assuming Gaussian errors
+# of unknown variance, i.e.
+#     logL = -n/2 * (log(2*pi*RSS/n) + 1)
+# Works element-wise on arrays of RSS and numbers of datapoints
+def logLikelihood(RSS, nDataPoints):
+    """Return the log likelihood of least square fits given their RSS and number of datapoints"""
+    n = np.asarray(nDataPoints, dtype=float)
+    with np.errstate(all='ignore'):
+        return -n/2 * (np.log(2*np.pi*np.asarray(RSS, dtype=float)/n) + 1)
+
+
+# Compute the Akaike information criterion of least square fits
+#     AIC = 2k - 2*logL
+# where k = nParams + 1 to account for the estimated error variance
+def AIC(RSS, nDataPoints, nParams):
+    """Return the Akaike information criterion of least square fits"""
+    return 2*(np.asarray(nParams) + 1) - 2*logLikelihood(RSS, nDataPoints)
+
+
+# Compute the Bayesian information criterion of least square fits
+#     BIC = k*log(n) - 2*logL
+# where k = nParams + 1 to account for the estimated error variance
+def BIC(RSS, nDataPoints, nParams):
+    """Return the Bayesian information criterion of least square fits"""
+    with np.errstate(divide='ignore'):
+        return (np.asarray(nParams) + 1)*np.log(nDataPoints) - 2*logLikelihood(RSS, nDataPoints)
+
+
+# Do F-tests between two sets of nested models given arrays of their RSS and DOF
+# The model with more DOF in each pair is taken as the simpler one
+#     F = ((RSS_simple - RSS_complex)/(DOF_simple - DOF_complex)) / (RSS_complex/DOF_complex)
+# with (DOF_simple - DOF_complex, DOF_complex) degrees of freedom
+def fTestBatch(RSS1, DOF1, RSS2, DOF2):
+    """Do F-tests between arrays of RSS/DOF of two models and return arrays of F scores and p values"""
+    RSS1, DOF1, RSS2, DOF2 = [np.asarray(a, dtype=float) for a in [RSS1, DOF1, RSS2, DOF2]]
+    oneIsSimpler = DOF1 >= DOF2
+    RSSsimple = np.where(oneIsSimpler, RSS1, RSS2)
+    RSScomplex = np.where(oneIsSimpler, RSS2, RSS1)
+    DOFsimple = np.where(oneIsSimpler, DOF1, DOF2)
+    DOFcomplex = np.where(oneIsSimpler, DOF2, DOF1)
+    with np.errstate(all='ignore'):
+        fScore = ((RSSsimple - RSScomplex)/(DOFsimple - DOFcomplex)) / (RSScomplex/DOFcomplex)
+        pValue = stats.f.sf(fScore, DOFsimple - DOFcomplex, DOFcomplex)
+    return fScore, pValue
+
+
+# Compare two models fitted to the same data, row by row
+# model1 and model2 can be lsqcurvefit, batchcurvefit or fitresults objects
+# (the latter need RSS, DOF and nDataPoints stored)
+def compareModels(model1, model2, index=None):
+    """Return a Pandas dataframe of F scores, p values, log likelihoods, AIC and BIC
+    comparing two models fitted to the same data, one row per fit
+    """
+    fScore, pValue = fTestBatch(model1.RSS, model1.DOF, model2.RSS, model2.DOF)
+    nParams1 = np.asarray(model1.nDataPoints) - np.asarray(model1.DOF)
+    nParams2 = np.asarray(model2.nDataPoints) - np.asarray(model2.DOF)
+    comparison = pd.DataFrame({'fScore': np.atleast_1d(fScore),
+                               'pValue': np.atleast_1d(pValue),
+                               'logL1': np.atleast_1d(logLikelihood(model1.RSS, model1.nDataPoints)),
+                               'logL2': np.atleast_1d(logLikelihood(model2.RSS, model2.nDataPoints)),
+                               'AIC1': np.atleast_1d(AIC(model1.RSS, model1.nDataPoints, nParams1)),
+                               'AIC2': np.atleast_1d(AIC(model2.RSS, model2.nDataPoints, nParams2)),
+                               'BIC1': np.atleast_1d(BIC(model1.RSS, model1.nDataPoints, nParams1)),
+                               'BIC2': np.atleast_1d(BIC(model2.RSS, model2.nDataPoints, nParams2))},
+                              columns=['fScore', 'pValue', 'logL1', 'logL2', 'AIC1', 'AIC2', 'BIC1', 'BIC2'],
+                              index=index)
+    return comparison
+
+
 # This function does NOT belong to the lsqcurvefit class
 def fTest(model1, model2):
     """Do a F-test against two lsqcurvefit objects fitted with different models and return F score and p value"""
-    if model1.DOF <= model2.DOF:
-        fScore = ((model1.RSS - model2.RSS)/(float(model1.DOF) - float(model2.DOF))) / (model2.RSS/float(model2.DOF))
-        pValue = stats.f.sf(fScore, model1.DOF, model2.DOF)
-        return fScore, pValue
-    else:
-        fScore = ((model2.RSS - model1.RSS)/(float(model2.DOF) - float(model1.DOF))) / (model1.RSS/float(model1.DOF))
-        pValue = stats.f.sf(fScore, model2.DOF, model1.DOF)
-        return fScore, pValue
+    fScore, pValue = fTestBatch(model1.RSS, model1.DOF, model2.RSS, model2.DOF)
+    return float(fScore), float(pValue)
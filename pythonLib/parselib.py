@@ -9,9 +9,17 @@ import pandas as pd
 
 
 # Split a column containing separator-separated values into individual
-# columns and assign to new numpy array
-def splitConcatedDFColumnIntoNDarray(column, separator=':'):
-    return np.array(column.str.split(separator).tolist()).astype(float)
+# columns and assign to new numpy array of type dtype (e.g. np.float32 to
+# halve the memory footprint of large signal matrices)
+# Rows with fewer values than the longest row (e.g. unevenly sampled time
+# series) are padded with nan
+def splitConcatedDFColumnIntoNDarray(column, separator=':', dtype=float):
+    listValues = column.str.split(separator).tolist()
+    listLengths = [len(values) for values in listValues]
+    if len(set(listLengths)) > 1:
+        nCols = max(listLengths)
+        listValues = [values + ['nan'] * (nCols - len(values)) for values in listValues]
+    return np.array(listValues).astype(dtype)
 
 
 # Split a column containing separator-separated values into individual
@@ -19,16 +19,190 @@ from joblib import Parallel, delayed
 import multiprocessing
 
 
+# Make the fit parameters of a single cluster with its own warm-start params0 and bounds
+def warmStartFitParams(fitParamDict, params0, lowerBounds, upperBounds):
+    bounds = [(None if np.isinf(lb) else lb, None if np.isinf(ub) else ub)
+              for lb, ub in izip(lowerBounds, upperBounds)]
+    return dict(fitParamDict, params0=params0, bounds=bounds)
+
+
+# Fit a chunk of single clusters as specified by the fitspec spec and keep only
+# the attributes in attrs, stored as floatType
+# If warmStart = (params0s, lowerBounds, upperBounds) is given, use per-cluster
+# initial guesses and bounds
+def fitChunk(listIndepVar, signals, spec, attrs, warmStart=None, floatType=float):
+    fitParamDict = spec.fitParamDict
+    fitRes = fitlib.fitresults(len(signals), len(spec.params0), attrs=attrs, floatType=floatType)
+    for i, (indepVar, signal) in enumerate(izip(listIndepVar, signals)):
+        if warmStart is None:
+            currFitParamDict = fitParamDict
+        else:
+            currFitParamDict = warmStartFitParams(fitParamDict, *[a[i] for a in warmStart])
+        fitRes.fill(i, fitlib.lsqcurvefit(x=indepVar, y=signal, **currFitParamDict))
+    return fitRes
+
+
+# Fit the clusters in the dataframe clusters as specified by the fitspec spec and the
+# command line options args, keeping the attributes in fitAttrs, stored as floatType
+# Variant fits used as initial guesses are computed from the clusters in the dataframe,
+# given the annotation annot. Clusters are looked up in and stored to the fitcache cache
+# if provided. Signals already parsed from the dataframe can be given as allSignals
+# Returns a fitresults object
+def fitClusters(clusters, spec, args, fitAttrs, floatType=float, annot=None, cache=None, allSignals=None):
+    fitParamDict = spec.fitParamDict
+    x = spec.x
+    if allSignals is None:
+        allSignals = parselib.splitConcatedDFColumnIntoNDarray(clusters['signals'], ':', dtype=floatType)
+    # Parse per-cluster independent variables if x is a column name
+    # Clusters with fewer datapoints are padded with nan in both x and signals, so that
+    # unevenly sampled clusters are fitted together in the batch and global fitters,
+    # which mask missing datapoints
+    if isinstance(x, str):
+        x = parselib.splitConcatedDFColumnIntoNDarray(clusters[x], ':')
+        nCols = max(x.shape[1], allSignals.shape[1])
+        x = np.pad(x, ((0, 0), (0, nCols - x.shape[1])), 'constant', constant_values=np.nan)
+        allSignals = np.pad(allSignals, ((0, 0), (0, nCols - allSignals.shape[1])), 'constant', constant_values=np.nan)
+
+    # Fit the median of each variant and use the variant fits as initial guesses
+    # (and bounds if requested) of the fits of their clusters
+    if annot is not None:
+        variants = clusters['clusterID'].map(annot['variant_number'])
+        allParams0, allBounds, _ = fitlib.groupWarmStart(fitParamDict['func'], x, allSignals, variants,
+                                                         fitParamDict['params0'], bounds=fitParamDict['bounds'],
+                                                         constants=fitParamDict['constants'], boundsSE=args.warmBoundsSE,
+                                                         dataInit=args.dataInit,
+                                                         maxiter=fitParamDict['maxiter'], tol=fitParamDict['tol'],
+                                                         epsilon=fitParamDict['epsilon'], finiteDiff=fitParamDict['finiteDiff'],
+                                                         loss=fitParamDict['loss'], lossScale=fitParamDict['lossScale'])
+        allLowerBounds = np.column_stack([lb for lb, ub in allBounds])
+        allUpperBounds = np.column_stack([ub for lb, ub in allBounds])
+    # Otherwise compute initial guesses of the fits of the clusters from their data if requested
+    elif args.dataInit:
+        allParams0 = fitlib.dataDrivenParams0(fitParamDict['func'], x, allSignals, fitParamDict['params0'],
+                                              bounds=fitParamDict['bounds'], constants=fitParamDict['constants'])
+        bounds = fitParamDict['bounds'] or [(None, None)] * allParams0.shape[1]
+        allLowerBounds = np.tile([-np.inf if lb is None else lb for lb, ub in bounds], (len(allSignals), 1)).astype(float)
+        allUpperBounds = np.tile([np.inf if ub is None else ub for lb, ub in bounds], (len(allSignals), 1)).astype(float)
+    isWarmStart = bool(annot is not None or args.dataInit)
+
+    # Look up clusters in the fit cache and only fit the ones not found
+    nClusters = len(allSignals)
+    nParams = len(fitParamDict['params0'])
+    if cache is not None:
+        isPerCluster = isinstance(x, np.ndarray) and x.ndim == 2
+        rowArrays = [allSignals]
+        if isPerCluster:
+            rowArrays.append(x)
+        if isWarmStart:
+            rowArrays += [allParams0, allLowerBounds, allUpperBounds]
+        allKeys = cache.rowKeys(*rowArrays)
+        isCached, fitRes = cache.lookup(allKeys)
+        idxToFit = np.flatnonzero(~isCached)
+    else:
+        fitRes = fitlib.fitresults(nClusters, nParams, attrs=fitAttrs, floatType=floatType)
+        idxToFit = np.arange(nClusters)
+
+    # Fit single clusters
+    if len(idxToFit) == 0:
+        newFitRes = fitlib.fitresults(0, nParams, attrs=fitAttrs, floatType=floatType)
+    elif args.batch or args.globalFit:
+        if fitParamDict['constraints']:
+            raise ValueError("Constraints are not supported by the batch and global fitters!")
+        batchFitParamDict = {key: fitParamDict[key]
+                             for key in ['func', 'params0', 'constants', 'bounds', 'sigma', 'maxiter', 'tol', 'epsilon', 'finiteDiff', 'loss', 'lossScale']}
+        if isWarmStart:
+            batchFitParamDict['params0'] = allParams0[idxToFit]
+            batchFitParamDict['bounds'] = list(izip(allLowerBounds[idxToFit].T, allUpperBounds[idxToFit].T))
+        if args.globalFit:
+            batchFitClass = fitlib.globalcurvefit
+            batchFitParamDict['sharedParams'] = [int(j) for j in args.sharedParams.split(',')]
+            if args.globalFit == 'variant':
+                # Clusters without a variant each form a group of their own
+                groups, _ = pd.factorize(variants.values[idxToFit])
+                isUnannotated = groups < 0
+                groups[isUnannotated] = groups.max() + 1 + np.arange(isUnannotated.sum())
+                batchFitParamDict['groups'] = groups
+            else:
+                batchFitParamDict['groups'] = None
+        else:
+            batchFitClass = fitlib.batchcurvefit
+        if isinstance(x, np.ndarray) and x.ndim == 2:
+            batchFitObj = batchFitClass(x=x[idxToFit], y=allSignals[idxToFit], **batchFitParamDict)
+        else:
+            batchFitObj = batchFitClass(x=x, y=allSignals[idxToFit], **batchFitParamDict)
+        newFitRes = fitlib.fitresults(len(idxToFit), nParams, attrs=fitAttrs, floatType=floatType)
+        newFitRes.fill(slice(None), batchFitObj)
+        del batchFitObj
+    else:
+        listIdxChunks = np.array_split(idxToFit, args.numCores)
+        if isinstance(x, np.ndarray) and x.ndim == 2:
+            listIndepVarChunks = [x[idx] for idx in listIdxChunks]
+        else:
+            listIndepVarChunks = [[x] * len(idx) for idx in listIdxChunks]
+        if isWarmStart:
+            listWarmStartChunks = [(allParams0[idx], allLowerBounds[idx], allUpperBounds[idx]) for idx in listIdxChunks]
+        else:
+            listWarmStartChunks = [None] * len(listIdxChunks)
+        listFitRes = Parallel(n_jobs=args.numCores, verbose=args.verbose)(delayed(fitChunk)(indepVarChunk, allSignals[idx], spec, fitAttrs, warmStart, floatType)
+                                                                          for idx, indepVarChunk, warmStart in izip(listIdxChunks, listIndepVarChunks, listWarmStartChunks))
+        newFitRes = fitlib.fitresults.concat(listFitRes)
+
+    # Merge new fit results with cached ones and update the cache
+    fitRes.records[idxToFit] = newFitRes.records
+    if cache is not None:
+        cache.store(allKeys[idxToFit], newFitRes.records)
+
+
+    return fitRes
+
+
+# Fit the clusters in the dataframe clusters with each of the fitspecs in listSpecs, parsing
+# their signals only once, and add the attributes in the outputAttrs of each fitspec as
+# columns prefixed with the corresponding prefix in listPrefixes
+# Returns the dataframe with the added columns and the list of fitresults objects
+def fitModels(clusters, listSpecs, listPrefixes, args, listFitAttrs, floatType=float, annot=None, listCaches=None):
+    allSignals = parselib.splitConcatedDFColumnIntoNDarray(clusters['signals'], ':', dtype=floatType)
+    if listCaches is None:
+        listCaches = [None] * len(listSpecs)
+    listFitRes = []
+    for spec, prefix, fitAttrs, cache in izip(listSpecs, listPrefixes, listFitAttrs, listCaches):
+        fitRes = fitClusters(clusters, spec, args, fitAttrs, floatType, annot, cache, allSignals)
+        clusters = clusters.join(fitRes.toDataFrame(spec.outputAttrs, index=clusters.index).add_prefix(prefix))
+        listFitRes.append(fitRes)
+    return clusters, listFitRes
+
+
 def main():
 
     # Get options and arguments from command line
     parser = argparse.ArgumentParser(description="fit single clusters")
     parser.add_argument('-n', '--numCores', type=int, default=1, help="number of cores to use (default=1)")
     parser.add_argument('-v', '--verbose', type=int, default=0, help="verbosity of progress. 0 = no verbosity. (default=0)")
-    parser.add_argument('fitParamFilePath', help="path to the file that specifies fitting parameters")
+    parser.add_argument('-b', '--batch', action='store_true', default=False, help="fit all clusters at once with the vectorized batch fitter, also when x is given per cluster with different numbers of datapoints. Only bounds are supported as constraints (default=false)")
+    parser.add_argument('-a', '--annotFilePath', help="path to the CPannot.pkl file. If provided, fit the median of each variant first and use the variant fits as initial guesses of the fits of their clusters")
+    parser.add_argument('-i', '--dataInit', action='store_true', default=False, help="compute initial guesses of each cluster (or of each variant median if --annotFilePath is provided) from its data with the initializer of the fit function in fitfuns, falling back to the params0 of fitParamFile (default=false)")
+    parser.add_argument('--warmBoundsSE', type=float, help="if provided along with --annotFilePath, bound the parameters of each cluster to within this many standard errors of its variant's fitted parameters")
+    parser.add_argument('-g', '--globalFit', choices=['tile', 'variant'], help="fit all clusters globally, with the parameters in --sharedParams shared by all clusters of the tile or of each variant. Fitting by variant requires --annotFilePath, and clusters without a variant are fitted on their own. Only bounds are supported as constraints")
+    parser.add_argument('-s', '--sharedParams', help="comma-separated indices of the parameters shared in a global fit (e.g. 3 or 0,3)")
+    parser.add_argument('-c', '--cacheDir', help="directory of the fit cache. If provided, clusters already fitted with the same data and fit parameters are read from the cache and only new or changed clusters are fitted")
+    parser.add_argument('-t', '--telemetry', help="prefix of the output files of the convergence telemetry. If provided, write a summary table of the iterations, function evaluations, fitting time, failures and bound-hitting parameters of the fits to <prefix>.summary.txt and their histograms to <prefix>.hist.png")
+    parser.add_argument('--float32', action='store_true', default=False, help="store the signals and the fit results in single precision to halve their memory footprint. Fits are still computed in double precision (default=false)")
+    parser.add_argument('--chunkSize', type=int, help="if provided, read, fit and write the clusters in chunks of this many clusters, appending the results of each chunk to the output file as soon as it is fitted. Variant fits used as initial guesses with --annotFilePath are computed within each chunk")
+    parser.add_argument('-r', '--resume', action='store_true', default=False, help="resume an interrupted run with --chunkSize from the checkpoint saved after each chunk in <outputFilePath>.checkpoint.npz (removed once the run is complete), skipping the chunks already written to the output file. The inputs and options must be unchanged. The telemetry only covers the chunks fitted after resuming (default=false)")
+    parser.add_argument('fitParamFilePath', help="path to the file that specifies fitting parameters, or comma-separated paths to several such files to fit each model in one pass over the data. The output columns of each model are then prefixed with the name of its file (e.g. singleExp_params1 for singleExp.py)")
     parser.add_argument('inputFilePath', help="path to the file containing the raw signals of the clusters to be fitted")
     parser.add_argument('outputFilePath', help="path to the output file")
     args = parser.parse_args()
+    if args.globalFit and not args.sharedParams:
+        parser.error("--globalFit requires --sharedParams")
+    if args.globalFit == 'variant' and not args.annotFilePath:
+        parser.error("--globalFit variant requires --annotFilePath")
+    if args.globalFit and args.cacheDir:
+        parser.error("--cacheDir is not supported with --globalFit since clusters are not fitted independently")
+    if args.globalFit and args.chunkSize:
+        parser.error("--chunkSize is not supported with --globalFit since clusters are not fitted independently")
+    if args.resume and not args.chunkSize:
+        parser.error("--resume requires --chunkSize")
 
     # Define default attributes from the fit result to write to the output file
 #    outputAttrs = ['params',
@@ -41,33 +215,108 @@ def main():
 #                   'nit',
 #                   'status']
 
-    # Import fit parameters from fitParamFile
-    fitParamDict, x, outputAttrs = fitlib.lsqcurvefit.parseFitParamFromFile(args.fitParamFilePath)
+    # Parse and validate fit parameters from fitParamFile(s)
+    # With several fitParamFiles, the output columns and telemetry files of each model are
+    # named after its fitParamFile
+    listFitParamFilePaths = args.fitParamFilePath.split(',')
+    listSpecs = [fitlib.fitspec.fromFile(filePath) for filePath in listFitParamFilePaths]
+    if len(listSpecs) > 1:
+        listModelNames = [os.path.splitext(os.path.basename(filePath))[0] for filePath in listFitParamFilePaths]
+        if len(set(listModelNames)) < len(listModelNames):
+            parser.error("fitParamFiles must have different names")
+        if args.globalFit:
+            parser.error("--globalFit supports a single fitParamFile")
+        listPrefixes = [name+'_' for name in listModelNames]
+        listTelemetryPrefixes = [args.telemetry+'.'+name for name in listModelNames] if args.telemetry else None
+    else:
+        listPrefixes = ['']
+        listTelemetryPrefixes = [args.telemetry]
 
-    # Read inputFile as Pandas dataframe
-    allClusters = pd.read_csv(args.inputFilePath, sep='\t')
-    allSignals = parselib.splitConcatedDFColumnIntoNDarray(allClusters['signals'], ':')
-    if isinstance(x, str):
-        allIndepVar = parselib.splitConcatedDFColumnIntoNDarray(allClusters[x], ':')
+    # Record the convergence telemetry of the fits along with the output attributes if requested
+    telemetryAttrs = ['nit', 'nfev', 'njev', 'fitTime', 'success', 'message', 'atBound']
+    if args.telemetry:
+        listFitAttrs = [spec.outputAttrs + [attr for attr in telemetryAttrs if attr not in spec.outputAttrs]
+                        for spec in listSpecs]
+    else:
+        listFitAttrs = [spec.outputAttrs for spec in listSpecs]
 
-    # Fit single clusters
-    if isinstance(x, str):
-        fitResults = Parallel(n_jobs=args.numCores, verbose=args.verbose)(delayed(fitlib.lsqcurvefit)(x=indepVar, y=signal, **fitParamDict)
-                                                                          for indepVar, signal in izip(allIndepVar, allSignals))
+    # Read the annotation and the fit cache if requested
+    floatType = np.float32 if args.float32 else float
+    if args.annotFilePath:
+        annot = pd.read_pickle(args.annotFilePath)
+    else:
+        annot = None
+    if args.cacheDir:
+        listCaches = [fitlib.fitcache(args.cacheDir, attrs=fitAttrs, floatType=floatType, batch=args.batch,
+                                      x=None if isinstance(spec.x, str) else spec.x, **spec.fitParamDict)
+                      for spec, fitAttrs in izip(listSpecs, listFitAttrs)]
+    else:
+        listCaches = None
+
+    # Read inputFile as Pandas dataframe and fit all clusters at once, adding attributes
+    # as defined in outputAttrs as columns in the allClusters dataframe
+    if not args.chunkSize:
+        allClusters = pd.read_csv(args.inputFilePath, sep='\t')
+        allClusters, listFitRes = fitModels(allClusters, listSpecs, listPrefixes, args, listFitAttrs,
+                                            floatType, annot, listCaches)
+
+        allClusters.to_csv(args.outputFilePath, sep='\t', index=False)
+
+    # Or read, fit and write inputFile chunk by chunk so that memory usage does not grow
+    # with the number of clusters, and the chunks already fitted are kept in the output
+    # file if fitting is interrupted
+    # A checkpoint is saved after each chunk so that an interrupted run can be resumed
+    # from the last chunk written
+    # Only the telemetry attributes of the fits are kept across chunks
     else:
-        fitResults = Parallel(n_jobs=args.numCores, verbose=args.verbose)(delayed(fitlib.lsqcurvefit)(x=x, y=signal, **fitParamDict)
-                                                                          for signal in allSignals)
-
-    # Add attributes as defined in outputAttrs as columns in the allClusters dataframe
-    for attr in outputAttrs:
-        val0 = getattr(fitResults[0], attr)
-        if not isinstance(val0, np.ndarray):
-            allClusters[attr] = [getattr(r, attr) for r in fitResults]
+        inputFilePaths = listFitParamFilePaths + [args.inputFilePath]
+        if args.annotFilePath:
+            inputFilePaths.append(args.annotFilePath)
+        checkpoint = fitlib.fitcheckpoint(args.outputFilePath+'.checkpoint.npz', inputFilePaths,
+                                          attrs=[spec.outputAttrs for spec in listSpecs], batch=args.batch,
+                                          dataInit=args.dataInit, warmBoundsSE=args.warmBoundsSE,
+                                          float32=args.float32, chunkSize=args.chunkSize)
+        if args.resume:
+            nDone, state = checkpoint.load()
         else:
-            attrNames = [attr+str(i+1) for i in range(len(val0))]
-            allClusters = allClusters.join(pd.DataFrame([getattr(r, attr) for r in fitResults], columns=attrNames))
+            nDone, state = 0, {}
+        if nDone > 0:
+            # Drop the part of the output file written after the last checkpoint
+            with open(args.outputFilePath, 'r+b') as f:
+                f.truncate(int(state['outputSize']))
+            print "Resuming after {} clusters".format(nDone)
+
+        listListTelemetryRes = [[] for spec in listSpecs]
+        nSkipped = nDone
+        reader = pd.read_csv(args.inputFilePath, sep='\t', chunksize=args.chunkSize,
+                             skiprows=lambda i: 0 < i <= nSkipped)
+        for i, clusters in enumerate(reader):
+            clusters, listFitRes = fitModels(clusters, listSpecs, listPrefixes, args, listFitAttrs,
+                                             floatType, annot, listCaches)
+            isFirstChunk = (nDone == 0)
+            clusters.to_csv(args.outputFilePath, sep='\t', index=False, header=isFirstChunk, mode='w' if isFirstChunk else 'a')
+            nDone += len(clusters)
+            checkpoint.save(nDone, outputSize=os.path.getsize(args.outputFilePath))
+            if args.telemetry:
+                for fitRes, listTelemetryRes in izip(listFitRes, listListTelemetryRes):
+                    telemetryRes = fitlib.fitresults(fitRes.nFits, fitRes.nParams, attrs=telemetryAttrs, floatType=floatType)
+                    for attr in telemetryAttrs:
+                        telemetryRes.records[attr] = fitRes.records[attr]
+                    listTelemetryRes.append(telemetryRes)
+            if args.verbose:
+                print "Fitted chunk {} ({} clusters)".format(i+1, len(clusters))
+            del clusters, listFitRes
+        checkpoint.remove()
+        if args.telemetry:
+            listFitRes = [fitlib.fitresults.concat(listTelemetryRes) if listTelemetryRes else None
+                          for listTelemetryRes in listListTelemetryRes]
 
-    allClusters.to_csv(args.outputFilePath, sep='\t', index=False)
+    # Write the convergence telemetry of the fits of each model
+    if args.telemetry:
+        for fitRes, telemetryPrefix in izip(listFitRes, listTelemetryPrefixes):
+            if fitRes is not None:
+                fitRes.telemetrySummary().to_csv(telemetryPrefix+'.summary.txt', sep='\t')
+                fitRes.plotTelemetry().savefig(telemetryPrefix+'.hist.png')
 
     return 1
 
@@ -12,6 +12,7 @@ import argparse
 import numpy as np
 import pandas as pd
 import fitlib
+from joblib import Parallel, delayed
 
 
 def binding(params, conc):
@@ -32,49 +33,149 @@ def jac_binding(params, conc):
     partial_dG = - (fmax - fmin) * E / (RT * (1 + E)**2)
     partial_b = - 1 / (1 + E) + 1
     partial_A = 1 / (1 + E)
-    return np.vstack([partial_dG, partial_b, partial_A]).T
+    return np.moveaxis(np.stack(np.broadcast_arrays(partial_dG, partial_b, partial_A)), 0, -1)
 
-def fit(row, conc, params0, bounds, method, sigma=None):
+def init_binding(conc, y):
+    RT = 0.59248475334
+    y = np.array(y, dtype=float, ndmin=2)
+    order = np.argsort(conc)
+    conc = np.asarray(conc, dtype=float)[order]
+    y = y[:, order]
+    fmin = pd.DataFrame(y).bfill(axis=1).values[:, 0]
+    fmax = pd.DataFrame(y).ffill(axis=1).values[:, -1]
+    with np.errstate(all='ignore'):
+        fraction = (y - fmin[:, None]) / (fmax - fmin)[:, None]
+        Kd = conc * (1 / fraction - 1)
+        Kd[~((fraction > 0.05) & (fraction < 0.95))] = np.nan
+        dG = RT * np.log(pd.DataFrame(Kd).median(axis=1).values)
+    return np.column_stack([dG, fmin, fmax])
+
+def sigma_from_sem(df_m, df_s):
+    df_s = df_s.reindex(index=df_m.index, columns=df_m.columns)
+    sigmas = df_s.values.astype(float)
+    isValid = np.where(np.isfinite(sigmas), sigmas, 0) > 0
+    fill = pd.DataFrame(np.where(isValid, sigmas, np.nan)).median(axis=0).values
+    return pd.DataFrame(np.where(isValid, sigmas, fill), index=df_m.index, columns=df_m.columns)
+
+def fit(row, conc, params0, bounds, method, sigma=None, backend='minimize'):
     return fitlib.lsqcurvefit(binding, conc, row, params0, sigma=sigma,
-                              jac=jac_binding, bounds=bounds, method=method, disp=False)
-    
+                              jac=jac_binding, bounds=bounds, method=method, backend=backend, disp=False)
+
+def fit_rows(conc, rows, params0s, bounds, method, attrs, sigmas=None, numBootstraps=None, backend='minimize'):
+    fitRes = fitlib.fitresults(len(rows), params0s.shape[1], attrs=attrs)
+    for j in range(len(rows)):
+        sigma = None if sigmas is None else sigmas[j]
+        fitObj = fit(rows[j], conc, params0s[j], bounds, method, sigma=sigma, backend=backend)
+        if numBootstraps:
+            fitObj.bootstrapCI(numBootstraps)
+        fitRes.fill(j, fitObj)
+    return fitRes
+
+def fit_batch(conc, rows, params0s, bounds, method, attrs, sigmas=None, numBootstraps=None, backend='minimize'):
+    fitObj = fitlib.batchcurvefit(binding, conc, rows, params0s, sigma=sigmas,
+                                  jac=jac_binding, bounds=bounds)
+    if numBootstraps:
+        fitObj.bootstrapCI(numBootstraps)
+    fitRes = fitlib.fitresults(len(rows), params0s.shape[1], attrs=attrs)
+    fitRes.fill(slice(None), fitObj)
+    # Refit one by one the variants whose batch fit did not converge or ended on a bound,
+    # where Levenberg-Marquardt can get pinned far from the minimum found by TNC
+    idxRefit = np.flatnonzero((fitObj.status != 1) | np.any(fitObj.atBound, axis=1))
+    if len(idxRefit) > 0:
+        fitRes.records[idxRefit] = fit_rows(conc, rows[idxRefit], params0s[idxRefit], bounds, method, attrs,
+                                            None if sigmas is None else sigmas[idxRefit], numBootstraps,
+                                            backend).records
+    return fitRes
+
 def fit_all(conc, df_m,
             params0=[-1, 0, 0.8], bounds=[(None, -0.9), (0, 1), (0, 1)],
-            method='TNC', df_s=None):
-    list_fitObj = []
-    for i in range(0, len(df_m)):
-        if i % 10000 == 0:
-            print "Fitting the {}th variant".format(i+1)
+            method='TNC', df_s=None, cacheDir=None, numBootstraps=None, telemetry=False,
+            dataInit=False, checkpoint=None, resume=False, checkpointEvery=10000,
+            numCores=1, batch=False, backend='minimize'):
+    attrs = ['params', 'paramSEs', 'paramPvals', 'R2', 'adjR2', 'reChi2', 'SER']
+    if numBootstraps:
+        attrs += ['paramLBs', 'paramUBs']
+    if telemetry:
+        attrs += ['nit', 'nfev', 'njev', 'fitTime', 'success', 'message', 'atBound']
+    if dataInit:
+        params0s = fitlib.dataDrivenParams0(binding, conc, df_m.values, params0,
+                                            bounds=bounds, init=init_binding)
+    else:
+        params0s = np.tile(params0, (len(df_m), 1))
+    if cacheDir is not None:
+        cache = fitlib.fitcache(cacheDir, binding, attrs=attrs, jac=jac_binding, x=conc,
+                                params0=params0, bounds=bounds, method=method, backend=backend,
+                                numBootstraps=numBootstraps, batch=batch)
+        rowArrays = [df_m.values]
         if df_s is not None:
-            fitObj = fit(df_m.iloc[i], conc, params0, bounds, method, sigma=df_s.iloc[i])
+            rowArrays.append(df_s.values)
+        if dataInit:
+            rowArrays.append(params0s)
+        keys = cache.rowKeys(*rowArrays)
+        isCached, fitRes = cache.lookup(keys)
+        idxToFit = np.flatnonzero(~isCached)
+        print "Found {} of {} variants in the fit cache".format(np.sum(isCached), len(df_m))
+    else:
+        fitRes = fitlib.fitresults(len(df_m), len(params0), attrs=attrs)
+        idxToFit = np.arange(len(df_m))
+    idxDone = np.array([], dtype=int)
+    if checkpoint is not None and resume:
+        nDone, state = checkpoint.load()
+        if nDone > 0:
+            idxDone = state['idxDone']
+            fitRes.records[idxDone] = state['records']
+            idxToFit = idxToFit[~np.in1d(idxToFit, idxDone)]
+            print "Resuming after {} variants".format(nDone)
+    rows = df_m.values
+    sigmas = df_s.values if df_s is not None else None
+    for start in range(0, len(idxToFit), checkpointEvery):
+        print "Fitting the {}th variant".format(len(idxDone)+1)
+        idx = idxToFit[start:start+checkpointEvery]
+        if batch:
+            blockRes = fit_batch(conc, rows[idx], params0s[idx], bounds, method, attrs,
+                                 None if sigmas is None else sigmas[idx], numBootstraps, backend)
         else:
-            fitObj = fit(df_m.iloc[i], conc, params0, bounds, method)
-        list_fitObj.append(fitObj)
-    return list_fitObj
-
-def extract(list_fitObj, num):
-    list_results = []
-    for i, fitObj in enumerate(list_fitObj):
-        curr_result = []
-        curr_result += list(fitObj.params)
-        curr_result += list(fitObj.paramSEs)
-        curr_result += list(fitObj.paramPvals)
-        curr_result.append(fitObj.R2)
-        curr_result.append(fitObj.adjR2)
-        curr_result.append(fitObj.reChi2)
-        curr_result.append(fitObj.SER)
-        curr_result.append(num['n'].iloc[i])
-        list_results.append(curr_result)
-    columns = ['dG', 'fmin', 'fmax',
-               'dG_SE', 'fmin_SE', 'fmax_SE',
-               'dG_pval', 'fmin_pval', 'fmax_SE_pval',
-               'R2', 'adjR2', 'reChi2', 'SER', 'count']
-    return pd.DataFrame(list_results, columns=columns, index=num.index)
+            listIdx = np.array_split(idx, numCores)
+            listFitRes = Parallel(n_jobs=numCores)(delayed(fit_rows)(conc, rows[j], params0s[j], bounds, method, attrs,
+                                                                     None if sigmas is None else sigmas[j], numBootstraps, backend)
+                                                   for j in listIdx)
+            blockRes = fitlib.fitresults.concat(listFitRes)
+        fitRes.records[idx] = blockRes.records
+        idxDone = np.concatenate([idxDone, idx])
+        if checkpoint is not None:
+            checkpoint.save(len(idxDone), idxDone=idxDone, records=fitRes.records[idxDone])
+    if cacheDir is not None:
+        cache.store(keys[idxDone], fitRes.records[idxDone])
+    return fitRes
+
+def extract(fitRes, num):
+    df_results = fitRes.toDataFrame(['params', 'paramSEs', 'paramPvals', 'R2', 'adjR2', 'reChi2', 'SER'],
+                                    index=num.index)
+    df_results['count'] = num['n'].values
+    df_results.columns = ['dG', 'fmin', 'fmax',
+                          'dG_SE', 'fmin_SE', 'fmax_SE',
+                          'dG_pval', 'fmin_pval', 'fmax_SE_pval',
+                          'R2', 'adjR2', 'reChi2', 'SER', 'count']
+    if 'paramLBs' in fitRes.records.dtype.names:
+        df_CIs = fitRes.toDataFrame(['paramLBs', 'paramUBs'], index=num.index)
+        df_CIs.columns = ['dG_lb', 'fmin_lb', 'fmax_lb',
+                          'dG_ub', 'fmin_ub', 'fmax_ub']
+        df_results = df_results.join(df_CIs)
+    return df_results
 
 def main():
 
     # Get options and arguments from command line
     parser = argparse.ArgumentParser(description="fit variants to curves")
+    parser.add_argument('-n', '--numCores', type=int, default=1, help="number of cores to use (default=1)")
+    parser.add_argument('-b', '--batch', action='store_true', default=False, help="fit all variants at once with the vectorized Levenberg-Marquardt batch fitter instead of one by one with TNC. Variants whose batch fit does not converge or ends on a bound are refitted one by one as without --batch. The other fits stop at slightly different points within the solver tolerances, except for variants whose curves are too flat to determine dG, which can end at different points with either solver (default=false)")
+    parser.add_argument('--backend', choices=['minimize', 'least_squares', 'auto'], default='minimize', help="backend of the one by one fits: 'minimize' to minimize the RSS with TNC, 'least_squares' to solve the bounded least square problem directly with its trust-region solver, which needs far fewer function evaluations, or 'auto' to use least_squares since the fits are only bounded. Ignored with --batch (default=minimize)")
+    parser.add_argument('-c', '--cacheDir', help="directory of the fit cache. If provided, variants already fitted with the same data are read from the cache")
+    parser.add_argument('--bootstrap', type=int, help="if provided, compute the 95%% bootstrap CIs of the fitted parameters from this number of resamples")
+    parser.add_argument('-t', '--telemetry', help="prefix of the output files of the convergence telemetry. If provided, write a summary table of the iterations, function evaluations, fitting time, failures and bound-hitting parameters of the fits to <prefix>.summary.txt and their histograms to <prefix>.hist.png")
+    parser.add_argument('-i', '--dataInit', action='store_true', default=False, help="compute initial guesses of each variant from its data (fmin and fmax at the lowest and highest concentrations, and dG from the half-maximal concentration) instead of using fixed initial guesses (default=false)")
+    parser.add_argument('-w', '--weighted', action='store_true', default=False, help="weight the datapoints of each variant by 1/sem^2 from the sem CPvariant file. Missing or zero sems (e.g. of variants with a single cluster) are replaced by the median sem at the same concentration (default=false)")
+    parser.add_argument('-r', '--resume', action='store_true', default=False, help="resume an interrupted run from the checkpoint saved every 10000 variants in <outputFilePath>.checkpoint.npz (removed once the run is complete). The inputs and options must be unchanged (default=false)")
     parser.add_argument('medCPvariantFilePath', help="path to the median CPvariant file")
     parser.add_argument('semCPvariantFilePath', help="path to the sem CPvariant file")
     parser.add_argument('countCPvariantFilePath', help="path to the count CPvariant file")
@@ -88,18 +189,38 @@ def main():
     sem = pd.read_csv(args.semCPvariantFilePath,
                       sep='\t', index_col=0)
     num = pd.read_csv(args.countCPvariantFilePath,
-                      sep='\t', index_col=0)
+                      sep='\t', index_col=0).reindex(median.index)
     # Read conc
     conc = pd.read_csv(args.concFilePath).values.flatten()
 
-    # Fit
-    list_fitObj = fit_all(conc, median.iloc[:, 1:])
+    # Align the sems with the medians if weighting is requested
+    if args.weighted:
+        df_s = sigma_from_sem(median.iloc[:, 1:], sem)
+        inputFilePaths = [args.medCPvariantFilePath, args.semCPvariantFilePath, args.concFilePath]
+    else:
+        df_s = None
+        inputFilePaths = [args.medCPvariantFilePath, args.concFilePath]
+
+    # Fit, saving a checkpoint every 10000 variants
+    checkpoint = fitlib.fitcheckpoint(args.outputFilePath+'.checkpoint.npz', inputFilePaths,
+                                      numBootstraps=args.bootstrap, telemetry=bool(args.telemetry),
+                                      dataInit=args.dataInit, batch=args.batch, weighted=args.weighted,
+                                      backend=args.backend)
+    fitRes = fit_all(conc, median.iloc[:, 1:], df_s=df_s, cacheDir=args.cacheDir, numBootstraps=args.bootstrap,
+                     telemetry=bool(args.telemetry), dataInit=args.dataInit,
+                     checkpoint=checkpoint, resume=args.resume, numCores=args.numCores,
+                     batch=args.batch, backend=args.backend)
     
     # Extract
-    df_results = extract(list_fitObj, num)
+    df_results = extract(fitRes, num)
 
     # Save
     df_results.to_csv(args.outputFilePath, sep='\t')
+    checkpoint.remove()
+    if args.telemetry:
+        paramNames = ['dG', 'fmin', 'fmax']
+        fitRes.telemetrySummary(paramNames).to_csv(args.telemetry+'.summary.txt', sep='\t')
+        fitRes.plotTelemetry(paramNames=paramNames).savefig(args.telemetry+'.hist.png')
 
     return 1
 
@@ -10,6 +10,7 @@
 # Import libraries
 import os, sys
 import argparse
+import numpy as np
 import pandas as pd
 
 
@@ -30,6 +31,7 @@ def main():
     # Get options and arguments from command line
     parser = argparse.ArgumentParser(description="combine, filter, and transform signals from different CPseries into one file")
     parser.add_argument('--outSuffix', help="suffix of the output file; _processed.CPseries.pkl by defualt")
+    parser.add_argument('--float32', action='store_true', default=False, help="store the numeric columns of the CPseries in single precision to halve their memory footprint (default=false)")
     parser.add_argument('annotFilePath', help="path to the CPannot.pkl file")
     parser.add_argument('funcFilePath', help="path to the file specifying the transform function")
     parser.add_argument('signalsFilePaths', nargs='*', help="paths to the CPseries to be combined")
@@ -42,7 +44,11 @@ def main():
     # Read signals from CPseries and combine tiles
     allClusters = []
     for i, tilePath in enumerate(args.signalsFilePaths):
-        allClusters.append(pd.read_csv(tilePath, sep='\t'))
+        tile = pd.read_csv(tilePath, sep='\t')
+        if args.float32:
+            floatCols = tile.select_dtypes(include=[np.float64]).columns
+            tile[floatCols] = tile[floatCols].astype(np.float32)
+        allClusters.append(tile)
     signals = pd.concat(allClusters, axis=0, join='outer', ignore_index=True)
 
     # Define output file path